@@ -0,0 +1,318 @@
+"""
+Benchmark and replay harness for the danbooru subscription engine.
+
+Runs the Scheduler, Dansub and Helper from cogs/danbooru.py against a local
+stand-in for the danbooru API and a fake discord channel, with synthetic
+subscription sets of increasing size. Reports per size:
+sweep time, API calls per sweep, rows written per sweep,
+delivery latency percentiles (post visible on the server -> message sent) and peak memory.
+
+usage (from the repository root):
+    python -m benchmarks.danbooru_scheduler --sizes 10 50 100 500 --mode query
+    python -m benchmarks.danbooru_scheduler --record data/bench_posts.json --record-count 1000
+    python -m benchmarks.danbooru_scheduler --fixture data/bench_posts.json --mode feed
+
+Without --fixture the server serves deterministic synthetic posts.
+"""
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import time
+import tracemalloc
+
+from cogs import danbooru
+from cogs.utils.danbooru_client import DanbooruClient
+from cogs.utils.ratelimit import TokenBucket
+
+
+URL_REGEX = re.compile(r'https?://\S+')
+
+
+def generate_posts(count, seed=0):
+    """synthetic posts shaped like the posts.json answers of danbooru"""
+    rng = random.Random(seed)
+    vocabulary = [f'tag_{i}' for i in range(400)]
+    # a few tags are on most posts, most tags are rare
+    weights = [1 / (i + 1) for i in range(len(vocabulary))]
+    posts = []
+    for post_id in range(1, count + 1):
+        tags = set(rng.choices(vocabulary, weights, k=rng.randint(10, 30)))
+        posts.append({
+            'id': post_id,
+            'created_at': '2020-01-01T00:00:00.000-05:00',
+            'rating': rng.choice('sqe'),
+            'tag_string': ' '.join(sorted(tags)),
+            'tag_string_meta': '',
+            'file_ext': 'jpg',
+            'has_large': False,
+            'file_url': f'https://cdn.donmai.us/original/{post_id:032x}.jpg',
+            'large_file_url': f'https://cdn.donmai.us/sample/{post_id:032x}.jpg',
+        })
+    return posts
+
+
+class FakeDanbooru:
+    """local danbooru api serving a fixed set of posts, more of them become visible every sweep"""
+
+    def __init__(self, posts, initially_visible, latency):
+        self.posts = sorted(posts, key=lambda post: post['id'])
+        self.visible = initially_visible
+        self.latency = latency
+        self.api_calls = 0
+        self.published_at = {post['id']: 0.0 for post in self.posts[:initially_visible]}
+
+    def publish(self, count):
+        now = time.monotonic()
+        for post in self.posts[self.visible:self.visible + count]:
+            self.published_at[post['id']] = now
+        self.visible = min(len(self.posts), self.visible + count)
+
+    @staticmethod
+    def matches(post, tags):
+        post_tags = set(post['tag_string'].split())
+        for tag in tags:
+            if tag.startswith('rating:'):
+                if post['rating'] != tag[len('rating:'):][:1]:
+                    return False
+            elif tag.startswith('-'):
+                if tag[1:] in post_tags:
+                    return False
+            elif tag not in post_tags:
+                return False
+        return True
+
+    async def posts_json(self, request):
+        self.api_calls += 1
+        await asyncio.sleep(self.latency)
+        tags = request.query.get('tags', '').split()
+        limit = int(request.query.get('limit', 20))
+        page = request.query.get('page', '1')
+        posts = [post for post in reversed(self.posts[:self.visible]) if self.matches(post, tags)]
+        if page.startswith('a'):
+            posts = [post for post in posts if post['id'] > int(page[1:])][-limit:]
+        elif page.startswith('b'):
+            posts = [post for post in posts if post['id'] < int(page[1:])][:limit]
+        else:
+            posts = posts[(int(page) - 1) * limit:int(page) * limit]
+        if request.query.get('random'):
+            posts = random.sample(posts, len(posts))
+        return web.json_response(posts)
+
+    async def profile_json(self, request):
+        self.api_calls += 1
+        return web.json_response({'tag_query_limit': 6})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/posts.json', self.posts_json)
+        app.router.add_get('/profile.json', self.profile_json)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f'<@{user_id}>'
+
+
+class FakeChannel:
+    """discord channel that records when each post url arrived"""
+
+    def __init__(self, channel_id, server):
+        self.id = channel_id
+        self.server = server
+        self.latencies = []
+        self.messages = 0
+
+    async def send(self, content):
+        now = time.monotonic()
+        self.messages += 1
+        for url in URL_REGEX.findall(content):
+            post_id = int(url.rsplit('/', 1)[1].split('.')[0], 16)
+            published_at = self.server.published_at.get(post_id)
+            if published_at:
+                self.latencies.append(now - published_at)
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def transaction(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def executemany(self, query, args):
+        self.pool.rows_written += len(args)
+
+    async def execute(self, query, *args):
+        self.pool.rows_written += 1
+
+
+class FakePool:
+    """stands in for the asyncpg pool, only counts the rows the scheduler writes"""
+
+    def __init__(self):
+        self.rows_written = 0
+
+    def acquire(self):
+        return FakeConnection(self)
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.db = FakePool()
+
+
+def build_subscriptions(count, channels, seed=1):
+    rng = random.Random(seed)
+    vocabulary = [f'tag_{i}' for i in range(400)]
+    subs = []
+    for sub_id in range(count):
+        tags = rng.sample(vocabulary[:100], rng.randint(1, 2))
+        if rng.random() < 0.2:
+            tags.append('rating:s')
+        channel = channels[sub_id % len(channels)]
+        users = [FakeUser(1000 + sub_id * 3 + i) for i in range(rng.randint(1, 3))]
+        subs.append(danbooru.Dansub(users, tags, [], None, channel, False, sub_id=sub_id))
+    return subs
+
+
+def build_tag_index(posts):
+    """tag index of the served posts, feed mode only indexes subs once aliases are known"""
+    counts = dict()
+    for post in posts:
+        for tag in post['tag_string'].split():
+            counts[tag] = counts.get(tag, 0) + 1
+    tag_index = danbooru.TagIndex()
+    tag_index.data = danbooru.TagData([(name, 0, count) for name, count in counts.items()])
+    return tag_index
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def wait_for_delivery(scheduler, timeout):
+    deadline = time.monotonic() + timeout
+    while scheduler.delivery.workers and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_size(size, args, posts):
+    server = FakeDanbooru(posts, args.initial_posts, args.latency / 1000)
+    base_url = await server.start()
+    tracemalloc.start()
+    bot = FakeBot(asyncio.get_event_loop())
+    client = DanbooruClient(auth_file='benchmarks/missing_auth_file.json')
+    client.base_url = base_url
+    if args.rate:
+        client.bucket = TokenBucket(args.rate, args.rate * 2)
+    channels = [FakeChannel(900 + i, server) for i in range(args.channels)]
+    scheduler = danbooru.Scheduler(bot, client, build_tag_index(posts))
+    scheduler.feed_mode = args.mode == 'feed'
+    scheduler.subscriptions = build_subscriptions(size, channels)
+
+    sweep_times, api_calls, rows_written = [], [], []
+    # the first sweep only sets the watermarks
+    for sweep in range(args.sweeps + 1):
+        calls_before, rows_before = server.api_calls, bot.db.rows_written
+        start = time.monotonic()
+        await danbooru.Scheduler.schedule_task.coro(scheduler)
+        if sweep:
+            sweep_times.append(time.monotonic() - start)
+            api_calls.append(server.api_calls - calls_before)
+            rows_written.append(bot.db.rows_written - rows_before)
+        server.publish(args.posts_per_sweep)
+    await wait_for_delivery(scheduler, args.delivery_timeout)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await scheduler.delivery.close(timeout=0)
+    await client.close()
+    await server.stop()
+
+    latencies = [latency for channel in channels for latency in channel.latencies]
+    messages = sum(channel.messages for channel in channels)
+    print(f"{size:>6} subs | sweep {statistics.mean(sweep_times):7.2f}s "
+          f"| api calls/sweep {statistics.mean(api_calls):7.1f} "
+          f"| rows written/sweep {statistics.mean(rows_written):6.1f} "
+          f"| messages {messages:5} "
+          f"| latency p50 {percentile(latencies, 0.5):6.2f}s p90 {percentile(latencies, 0.9):6.2f}s "
+          f"p99 {percentile(latencies, 0.99):6.2f}s "
+          f"| peak mem {peak_memory / 1024 / 1024:6.1f} MiB")
+
+
+async def record(path, count):
+    """records the newest posts of the real danbooru api as a fixture"""
+    client = DanbooruClient()
+    posts = []
+    page = None
+    while len(posts) < count:
+        params = {'limit': min(200, count - len(posts))}
+        if page:
+            params['page'] = page
+        async with client.get('/posts.json', params=params) as response:
+            response.raise_for_status()
+            images = await response.json()
+        if not images:
+            break
+        posts += images
+        page = f"b{min(image['id'] for image in images)}"
+    await client.close()
+    with open(path, 'w') as f:
+        json.dump(posts, f)
+    print(f"recorded {len(posts)} posts to {path}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 500])
+    parser.add_argument('--mode', choices=['query', 'feed'], default='query')
+    parser.add_argument('--sweeps', type=int, default=3)
+    parser.add_argument('--fixture', help='posts.json fixture recorded with --record')
+    parser.add_argument('--record', help='record the newest danbooru posts into this file and exit')
+    parser.add_argument('--record-count', type=int, default=1000)
+    parser.add_argument('--initial-posts', type=int, default=200)
+    parser.add_argument('--posts-per-sweep', type=int, default=50)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=50, help='simulated api latency in ms')
+    parser.add_argument('--rate', type=float, help='override the api budget in requests per second')
+    parser.add_argument('--delivery-timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    if args.record:
+        await record(args.record, args.record_count)
+        return
+    if args.fixture:
+        with open(args.fixture) as f:
+            posts = json.load(f)
+    else:
+        posts = generate_posts(args.initial_posts + args.posts_per_sweep * (args.sweeps + 1))
+    print(f"mode: {args.mode}, {len(posts)} posts, {args.sweeps} sweeps")
+    for size in args.sizes:
+        await run_size(size, args, posts)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
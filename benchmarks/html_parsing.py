@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of the scraped page parsers in cogs/utils/scraping.py.
+
+Compares, per fixture page in benchmarks/fixtures, the old approach
+(full BeautifulSoup html.parser tree, then the extraction the commands used to do)
+with the targeted BeautifulSoup fallback and the lxml backend (when lxml is installed).
+Also reports how long the event loop stays blocked per parse when run_parser hands the
+page to the worker pool instead.
+
+usage (from the repository root):
+    python -m benchmarks.html_parsing --iterations 50
+"""
+from bs4 import BeautifulSoup
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from cogs.utils import scraping
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def old_iqdb(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    matches = soup.find(id='pages')
+    return [match.attrs['href'] for match in matches.select('a')]
+
+
+def old_saucenao(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    return [(float(result.select('.resultsimilarityinfo')[0].contents[0][:-1]), result.select('a')[0]['href'])
+            for result in soup.select('.resulttablecontent')]
+
+
+def old_tineye(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    pages = []
+    for hidden in soup.find(class_='match').select('.hidden-xs'):
+        if str(hidden.contents[0]).startswith('Page:'):
+            pages.append(hidden.next_sibling['href'])
+    return pages
+
+
+def old_wolfram(xml):
+    soup = BeautifulSoup(xml, 'html.parser')
+    return soup.find('queryresult')['success'], [elem.contents for elem in soup.find_all('plaintext')]
+
+
+PAGES = [
+    ('iqdb.html', old_iqdb, scraping.parse_iqdb),
+    ('saucenao.html', old_saucenao, scraping.parse_saucenao),
+    ('tineye.html', old_tineye, scraping.parse_tineye),
+    ('wolfram.xml', old_wolfram, scraping.parse_wolfram),
+]
+
+
+def measure(func, text, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def measure_with_backend(func, text, iterations, lxml_module):
+    installed = scraping.lxml
+    scraping.lxml = lxml_module
+    try:
+        return measure(func, text, iterations)
+    finally:
+        scraping.lxml = installed
+
+
+async def measure_blocking(parser, text, iterations):
+    """longest time the event loop didn't get to run a 1ms ticker while the pool parsed"""
+    longest = 0
+    for _ in range(iterations):
+        ticks = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.001)
+
+        task = asyncio.ensure_future(ticker())
+        await scraping.run_parser(parser, text)
+        done.set()
+        await task
+        gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+        longest = max([longest] + gaps)
+    return longest * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    lxml_module = scraping.lxml
+    print(f"median ms per page, {args.iterations} iterations, lxml {'installed' if lxml_module else 'missing'}")
+    print(f"{'page':<15}{'size':>9}{'old bs4':>10}{'strainer':>10}{'lxml':>10}{'loop blocked (pool)':>22}")
+    for filename, old, new in PAGES:
+        with open(os.path.join(FIXTURES, filename), encoding='utf-8') as f:
+            text = f.read()
+        old_ms = measure(old, text, args.iterations)
+        strainer_ms = measure_with_backend(new, text, args.iterations, None)
+        lxml_ms = measure_with_backend(new, text, args.iterations, lxml_module) if lxml_module else float('nan')
+        blocked_ms = await measure_blocking(new, text, min(args.iterations, 10))
+        print(f"{filename:<15}{len(text) // 1024:>7}KB{old_ms:>10.2f}{strainer_ms:>10.2f}{lxml_ms:>10.2f}"
+              f"{blocked_ms:>20.2f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -1,5 +1,6 @@
 from discord.ext import commands
 from cogs.utils.dataIO import DataIO
+from cogs.utils.http import get_session, close_session
 import logging
 from logging.handlers import RotatingFileHandler
 import asyncpg
@@ -25,6 +26,7 @@ async def connect_db_and_start_bot():
     db_info = data_io.load_json("postgres")
     bot.db = await asyncpg.create_pool(database=db_info['dbname'], user=db_info['user'], password=db_info["password"],
                                        host="127.0.0.1")
+    get_session(bot)
 
     try:
         bot.load_extension("cogs.default")
@@ -32,6 +34,7 @@ async def connect_db_and_start_bot():
     except KeyboardInterrupt:
         print("closing connection")
         await bot.db.close()
+        await close_session(bot)
         await bot.logout()
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ from discord.ext import commands
 import discord
 
 import re
+from .utils.message_scanner import get_scanner
 
 
 class April(commands.Cog):
@@ -12,6 +13,12 @@ class April(commands.Cog):
                 1,
                 60,
                 commands.BucketType.channel)
+        self.scanner = get_scanner(bot)
+        self.scanner.register("april", self.on_uwu, phrases=("uwu", "owo"), ignore_case=True,
+                              check=lambda message: message.guild is not None)
+
+    def cog_unload(self):
+        self.scanner.unregister("april")
 
     async def uwuify_name(self, username: str):
         replace_map = {
@@ -32,13 +39,7 @@ class April(commands.Cog):
             sub_num += replacements
         return username, sub_num
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        message_low = message.content.lower()
-        if not ("uwu" in message_low or "owo" in message_low):
-            return
-        if not message.guild:
-            return
+    async def on_uwu(self, message, match):
         new_username, sub_num = await self.uwuify_name(
                 message.author.display_name)
         if sub_num == 0 and not message.author.display_name.lower().startswith("daddy") :
@@ -21,13 +21,13 @@ import discord
 import io
 import os.path
 import asyncpg
-import aiohttp
 import asyncio
 import logging
-import mimetypes as mime
 import typing
 from discord.ext import commands
 from .utils.checks import is_owner_or_moderator
+from .utils.media import fetch_media, MediaError
+from .utils.http import get_session
 class Contest(commands.Cog):
 
     def contestant_check(self, ctx):
@@ -39,13 +39,10 @@ class Contest(commands.Cog):
         self.bot = bot
         self.contestant_role = None
         self.contest_channel = None
-        self.session = aiohttp.ClientSession()
+        self.session = get_session(bot)
         self.bot.loop.create_task(self.setup_database())
         self.bot.loop.create_task(self.load_settings())
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
-
     async def load_settings(self):
         await asyncio.sleep(1)
         async with self.bot.db.acquire() as connection:
@@ -298,21 +295,21 @@ class Contest(commands.Cog):
                 submission = io.BytesIO(await attachment.read())
                 contest_entry = await self.contest_channel.send(file=discord.File(submission, attachment.filename))
             else:
-                file_ext = mime.guess_type(url)[0].split("/")[1]
-                if mime.guess_type(url)[0].split("/")[0] == "image":
-                    async with self.session.get(url) as resp:
-                        image_bytes = await resp.read()
-                        submission = io.BytesIO(image_bytes)
-                        try:
-                            contest_entry = await self.contest_channel.send(
-                                file=discord.File(submission, "submission."+file_ext))
-                        except discord.HTTPException as e:
-                            if e.status == 413:
-                                await ctx.send("File too big")
-                            return
-
-                else:
-                    await ctx.send("Please only send images")
+                if url is None:
+                    await ctx.send("Please attach an image or add a link to one")
+                    return
+                try:
+                    media = await fetch_media(self.session, url,
+                                              max_bytes=self.contest_channel.guild.filesize_limit)
+                except MediaError as e:
+                    await ctx.send(f"{e} Please only send images")
+                    return
+                try:
+                    contest_entry = await self.contest_channel.send(
+                        file=discord.File(io.BytesIO(media.data), "submission." + media.extension))
+                except discord.HTTPException as e:
+                    if e.status == 413:
+                        await ctx.send("File too big")
                     return
             await contest_entry.add_reaction("\N{THUMBS UP SIGN}")
             await contest_entry.add_reaction("\N{CROSS MARK}")
@@ -3,17 +3,55 @@ import discord
 import aiohttp
 import json
 import os
-import datetime
-from dateutil import parser
 import asyncio
 import re
+import gzip
+import bisect
+import heapq
+import difflib
+import datetime
+from array import array
+from collections import deque
 import traceback
 from .utils import checks
 from .utils.paginator import TextPages,FieldPages
+from .utils.ratelimit import TokenBucket
+from .utils.danbooru_client import get_client
+from .utils.cache import AsyncTTLCache
 import logging
 from os import path
 import typing
 
+# discord allows 5 messages per 5 seconds per channel
+CHANNEL_MESSAGES_PER_SECOND = 1
+CHANNEL_MESSAGE_BURST = 5
+MAX_CONCURRENT_SUBS = 10
+# maximum number of pages of the global post feed read per tick in feed mode
+MAX_FEED_PAGES = 5
+FEED_PAGE_SIZE = 200
+# number of random posts fetched at once for .danr, later calls are served from the batch
+RANDOM_BATCH_SIZE = 20
+# when blacklisted tags are filtered locally, up to this many pages are searched for a clean post
+BLACKLIST_PAGE_SIZE = 20
+BLACKLIST_MAX_PAGES = 3
+# seconds the delivery queue gets to send what is still queued when the cog is unloaded
+DELIVERY_DRAIN_TIMEOUT = 30
+# images per channel that can be removed again with .danu
+UNDO_HISTORY_SIZE = 100
+TAG_INDEX_MAX_AGE = datetime.timedelta(days=1)
+# only tags with at least this many posts are offered as corrections for typos
+TAG_SUGGESTION_MIN_POST_COUNT = 50
+# metatags that don't count against the account's tag limit
+DANBOORU_UNLIMITED_METATAGS = {'rating', 'status', 'limit'}
+# metatags can't be checked against a post's tag_string, subs using them are queried directly
+DANBOORU_METATAGS = {
+    'user', 'approver', 'commenter', 'comm', 'noter', 'noteupdater', 'artcomm', 'fav', 'ordfav', 'favgroup',
+    'pool', 'ordpool', 'locked', 'status', 'id', 'date', 'age', 'score', 'favcount', 'width', 'height',
+    'mpixels', 'ratio', 'filesize', 'filetype', 'source', 'parent', 'child', 'md5', 'order', 'limit',
+    'tagcount', 'gentags', 'arttags', 'chartags', 'copytags', 'metatags', 'pixiv', 'pixiv_id', 'search',
+    'upvote', 'downvote', 'commentary', 'disapproved', 'embedded', 'is', 'has', 'random', 'flagger',
+    'appealer', 'uploader', 'duration', 'upvotes', 'downvotes', 'exif', 'ai', 'unaliased',
+}
 
 
 class DanbooruTypeConverter(commands.Converter):
@@ -27,76 +65,290 @@ class DanbooruTypeConverter(commands.Converter):
             raise commands.BadArgument(f"type must be one of the following {','.join(types.keys())}")
 
 class Helper:
-    def __init__(self, session, bot, auth_file):
+    def __init__(self, client, bot, cache=None):
         self.bot = bot
-        self.session = session
-        self.auth_file = auth_file
-
+        self.client = client
+        # optional AsyncTTLCache for post lookups, only used for interactive commands
+        self.cache = cache
 
     async def lookup_pool(self, pool_id):
-        with open(self.auth_file) as file:
-            data = json.load(file)
-            user = data['user']
-            api_key = data['api_key']
-        auth = aiohttp.BasicAuth(user, api_key)
-        url = 'https://danbooru.donmai.us/pools/{}.json'.format(pool_id)
-        async with self.session.get(url, auth=auth) as response:
+        async with self.client.get('/pools/{}.json'.format(pool_id)) as response:
             if response.status == 200:
                 json_dump = await response.json()
                 return json_dump['name']
 
-    async def lookup_posts(self, limit=200):
+    async def lookup_posts(self, limit=200, **kwargs):
         params = {'limit': limit}
-        url = 'https://danbooru.donmai.us'
-        with open(self.auth_file) as file:
-            data = json.load(file)
-            user = data['user']
-            api_key = data['api_key']
-        auth = aiohttp.BasicAuth(user, api_key)
-        async with self.session.get('{}/posts.json'.format(url), params=params, auth=auth) as response:
+        for key, value in kwargs.items():
+            params[key] = value
+        async with self.client.get('/posts.json', params=params) as response:
             if response.status == 200:
                 json_dump = await response.json()
-                for image in json_dump:
-                    if image['has_large'] and image['file_ext'] == 'zip':
-                        image['file_url'] = self.build_url(url, image['large_file_url'])
-                    else:
-                        image['file_url'] = self.build_url(url, image['file_url'])
+                self._add_file_urls(json_dump)
                 return json_dump
             else:
                 return None
 
     async def lookup_tags(self, tags, **kwargs):
+        if self.cache is None:
+            return await self._lookup_tags(tags, **kwargs)
+        key = (tags, tuple(sorted(kwargs.items())))
+        return await self.cache.get_or_fetch(key, lambda: self._lookup_tags(tags, **kwargs))
+
+    async def lookup_newest(self, tags, is_allowed=None):
+        """
+        returns the newest post, when is_allowed is given the newest post it accepts
+        for that more posts are fetched and up to BLACKLIST_MAX_PAGES pages are searched
+        """
+        if is_allowed is None:
+            return await self.lookup_tags(tags, limit='1')
+        for page in range(1, BLACKLIST_MAX_PAGES + 1):
+            images = await self.lookup_tags(tags, limit=str(BLACKLIST_PAGE_SIZE), page=str(page))
+            if not images:
+                return images
+            allowed = [image for image in images if is_allowed(image)]
+            if allowed:
+                return allowed[:1]
+            if len(images) < BLACKLIST_PAGE_SIZE:
+                break
+        return []
+
+    async def lookup_random(self, tags, is_allowed=None):
+        """
+        returns one random post that is_allowed accepts
+        with a cache the posts are taken out of a batch of random posts
+        """
+        key = ('random', tags)
+        for _ in range(BLACKLIST_MAX_PAGES):
+            if self.cache is None:
+                images = await self._lookup_tags(tags, limit=str(RANDOM_BATCH_SIZE), random='true')
+            else:
+                images = await self.cache.get_or_fetch(
+                    key, lambda: self._lookup_tags(tags, limit=str(RANDOM_BATCH_SIZE), random='true'))
+            if not images:
+                return images
+            while images:
+                image = images.pop()
+                if is_allowed is None or is_allowed(image):
+                    if not images and self.cache is not None:
+                        self.cache.invalidate(key)
+                    return [image]
+            if self.cache is not None:
+                self.cache.invalidate(key)
+        return []
+
+    async def _lookup_tags(self, tags, **kwargs):
         params = {'tags' : tags}
         for key, value in kwargs.items():
             params[key] = value
-        with open(self.auth_file) as file:
-            data = json.load(file)
-            user = data['user']
-            api_key = data['api_key']
-        auth = aiohttp.BasicAuth(user, api_key)
-        url = 'https://danbooru.donmai.us'
-        async with self.session.get('{}/posts.json'.format(url), params=params, auth=auth) as response:
+        async with self.client.get('/posts.json', params=params) as response:
             if response.status == 200:
                 json_dump = await response.json()
-                for image in json_dump:
-                    if image['has_large'] and image['file_ext'] == 'zip':
-                        image['file_url'] = self.build_url(url, image['large_file_url'])
-                    else:
-                        image['file_url'] = self.build_url(url, image['file_url'])
+                self._add_file_urls(json_dump)
                 return json_dump
             else:
                 return None
 
-    def build_url(self, base_url: str, file_url: str):
-        if file_url.startswith("http"):
-            return file_url
-        if file_url[0] != "/":
-            file_url = "/" + file_url
-        return base_url + file_url
+    def _add_file_urls(self, images):
+        for image in images:
+            # deleted or restricted posts come without any file urls
+            if not image.get('file_url'):
+                continue
+            if image['has_large'] and image['file_ext'] == 'zip':
+                image['file_url'] = self.client.build_url(image['large_file_url'])
+            else:
+                image['file_url'] = self.client.build_url(image['file_url'])
+
+class TagData:
+    """
+    one version of the tag index, built in an executor and never changed afterwards,
+    so the event loop only ever sees a complete version
+    """
+
+    def __init__(self, rows=(), aliases=None, updated_at=None):
+        rows = sorted(rows)
+        # sorted tag names with their categories and post counts at the same position
+        self.names = [row[0] for row in rows]
+        self.categories = bytearray(row[1] for row in rows)
+        self.counts = array('l', (row[2] for row in rows))
+        self.aliases = aliases or dict()
+        # every tag as a "name\tcategory\tcount" line, searched with one regex instead of a python loop
+        self.blob = '\n'.join(f'{name}\t{category}\t{count}' for name, category, count in rows)
+        # popular tags grouped by their first character, the candidates for suggestions
+        candidates = dict()
+        for name, category, count in rows:
+            if count >= TAG_SUGGESTION_MIN_POST_COUNT:
+                candidates.setdefault(name[0], list()).append(name)
+        self.suggestion_candidates = candidates
+        self.updated_at = updated_at
+
+
+class TagIndex:
+    """
+    local copy of all danbooru tags with posts (name, category, post count) and the active tag aliases.
+    stored on disk as gzipped tsv files and refreshed periodically, answers tag searches
+    and suggestions without asking danbooru
+    """
+    tags_file = 'data/danbooru/tags.tsv.gz'
+    aliases_file = 'data/danbooru/tag_aliases.tsv.gz'
+
+    def __init__(self):
+        # replaced as a whole on the event loop, never changed in place
+        self.data = TagData()
+
+    @property
+    def loaded(self):
+        return bool(self.data.names)
+
+    @property
+    def aliases(self):
+        return self.data.aliases
+
+    @property
+    def updated_at(self):
+        return self.data.updated_at
+
+    def is_fresh(self, max_age: datetime.timedelta):
+        return self.updated_at is not None and datetime.datetime.utcnow() - self.updated_at < max_age
+
+    async def load(self):
+        """loads the index from disk"""
+        data = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        if data is not None:
+            self.data = data
+
+    def _read(self):
+        """reads the index from disk, blocking"""
+        if not os.path.exists(self.tags_file):
+            return None
+        rows = []
+        with gzip.open(self.tags_file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                name, category, count = line.rstrip('\n').split('\t')
+                rows.append((name, int(category), int(count)))
+        aliases = dict()
+        if os.path.exists(self.aliases_file):
+            with gzip.open(self.aliases_file, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    antecedent, consequent = line.rstrip('\n').split('\t')
+                    aliases[antecedent] = consequent
+        updated_at = datetime.datetime.utcfromtimestamp(os.path.getmtime(self.tags_file))
+        return TagData(rows, aliases, updated_at)
+
+    def _save_and_build(self, rows, aliases):
+        """writes the downloaded tags to disk and builds the new version of the index, blocking"""
+        rows.sort()
+        with gzip.open(self.tags_file + '.tmp', 'wt', encoding='utf-8') as f:
+            f.writelines(f'{name}\t{category}\t{count}\n' for name, category, count in rows)
+        with gzip.open(self.aliases_file + '.tmp', 'wt', encoding='utf-8') as f:
+            f.writelines(f'{antecedent}\t{consequent}\n' for antecedent, consequent in aliases.items())
+        os.replace(self.tags_file + '.tmp', self.tags_file)
+        os.replace(self.aliases_file + '.tmp', self.aliases_file)
+        return TagData(rows, aliases, datetime.datetime.utcnow())
+
+    async def _fetch_all(self, client, url, params):
+        """pages through a danbooru listing by id, yields every entry"""
+        page = None
+        while True:
+            page_params = dict(params, limit=1000)
+            if page:
+                page_params['page'] = page
+            async with client.get(url, params=page_params) as response:
+                if response.status != 200:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                      status=response.status)
+                entries = await response.json()
+            if not entries:
+                return
+            for entry in entries:
+                yield entry
+            page = f"b{min(entry['id'] for entry in entries)}"
+
+    async def refresh(self, client):
+        rows = []
+        params = {'search[hide_empty]': 'yes', 'only': 'id,name,category,post_count'}
+        async for tag in self._fetch_all(client, '/tags.json', params):
+            rows.append((tag['name'], tag['category'], tag['post_count']))
+        aliases = dict()
+        params = {'search[status]': 'active', 'only': 'id,antecedent_name,consequent_name'}
+        async for alias in self._fetch_all(client, '/tag_aliases.json', params):
+            aliases[alias['antecedent_name']] = alias['consequent_name']
+        self.data = await asyncio.get_event_loop().run_in_executor(None, self._save_and_build, rows, aliases)
+
+    def lookup(self, name):
+        """returns (category, post count) of a tag or None if it doesn't exist"""
+        data = self.data
+        index = bisect.bisect_left(data.names, name)
+        if index < len(data.names) and data.names[index] == name:
+            return data.categories[index], data.counts[index]
+        return None
+
+    async def search(self, query, category=None, limit=100):
+        """
+        returns (name, category, count) of tags containing the query, most used first.
+        scanning every tag takes a while, it runs in an executor on the current version of the index
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, self._search, self.data, query, category, limit)
+
+    def _search(self, data, query, category, limit):
+        query = query.lower().replace(' ', '_').strip('*')
+        if '*' in query:
+            pattern = re.escape(query).replace('\\*', '[^\\t\\n]*')
+            regex = re.compile(r'^([^\t\n]*' + pattern + r'[^\t\n]*)\t(\d)\t(\d+)$', re.MULTILINE)
+            lines = regex.findall(data.blob)
+        else:
+            lines = self._find_lines(data.blob, query)
+        matches = ((name, int(tag_category), int(count)) for name, tag_category, count in lines)
+        if category is not None:
+            matches = (match for match in matches if match[1] == category)
+        return heapq.nlargest(limit, matches, key=lambda match: match[2])
+
+    @staticmethod
+    def _find_lines(blob, query):
+        """yields the split lines of all tags containing query, str.find is a lot faster than a regex here"""
+        position = blob.find(query)
+        while position != -1:
+            start = blob.rfind('\n', 0, position) + 1
+            end = blob.find('\n', position)
+            if end == -1:
+                end = len(blob)
+            line = blob[start:end].split('\t')
+            # the query might have matched the category or post count
+            if query in line[0]:
+                yield line
+            position = blob.find(query, end)
+
+    def suggest(self, tag, n=5):
+        """returns the most similar popular tags"""
+        tag = tag.lower().replace(' ', '_')
+        candidates = self.data.suggestion_candidates.get(tag[:1], [])
+        candidates = [name for name in candidates if abs(len(name) - len(tag)) <= 3]
+        suggestions = difflib.get_close_matches(tag, candidates, n=n, cutoff=0.7)
+        return sorted(suggestions, key=lambda name: self.lookup(name)[1], reverse=True)
+
+    def unknown_tags(self, tags: str):
+        """
+        returns the plain tags of a query that neither exist nor are an alias.
+        negated and or-tags aren't checked, the query can still find posts when they don't exist.
+        the index can miss tags created since its last refresh, this only explains empty results
+        """
+        unknown = []
+        for tag in tags.lower().split():
+            if not tag or tag[0] in '-~' or '*' in tag:
+                continue
+            prefix, _, value = tag.partition(':')
+            if value and (prefix in DANBOORU_METATAGS or prefix == 'rating'):
+                continue
+            if tag in self.aliases or self.lookup(tag) is not None:
+                continue
+            unknown.append(tag)
+        return unknown
+
 
 class Dansub:
 
-    def __init__(self, users, tags, pools, server: discord.guild, channel: discord.TextChannel, is_private: bool, paused_users=None):
+    def __init__(self, users, tags, pools, server: discord.guild, channel: discord.TextChannel, is_private: bool, paused_users=None,
+                 sub_id=None, last_post_id=None):
         self.users = list()
         if type(users) == list:
             self.users += users
@@ -104,19 +356,31 @@ class Dansub:
             self.users.append(users)
         self.tags = tags
         self.pools = pools
+        self.guild = None
+        self.channel = None
         if not is_private:
             self.guild = server
             self.channel = channel
-        self.old_timestamp = None
-        self.new_timestamp = datetime.datetime
-        self.already_posted = list()
         self.is_private = is_private
-        self.feed_file = 'data/danbooru/subs/{}.json'.format(self.tags_to_filename())
+        self.sub_id = sub_id
+        # id of the newest post that was already sent
+        self.last_post_id = last_post_id
+        # id of the newest post handed to the delivery queue, only moves last_post_id once it was sent
+        self.queued_post_id = None
+        # set when the sub changed and its row has to be written to the database
+        self.dirty = False
         if paused_users:
             self.paused_users = paused_users
         else:
             self.paused_users = []
 
+    @property
+    def watermark(self):
+        """newest post that was sent or is waiting to be sent"""
+        if self.queued_post_id is None or (self.last_post_id or 0) > self.queued_post_id:
+            return self.last_post_id
+        return self.queued_post_id
+
     # use this one to create private subs
 
     def users_to_mention(self):
@@ -131,13 +395,6 @@ class Dansub:
         tags.sort()
         return tags == self.tags
 
-    def tags_to_filename(self):
-        # delete any character that isn't a word char - _ or . from the filename
-        if self.is_private:
-            return re.sub('[^\w\-_\.]','_', self.tags_to_string()) + str(self.users[0].id)
-        else:
-            return re.sub('[^\w\-_\.]','_', self.tags_to_string())
-
     def tags_to_message(self):
         tags_list = self.tags.copy()
         for tag in self.tags:
@@ -149,128 +406,466 @@ class Dansub:
                         tags_list.append(tag)
         return ' '.join(tags_list)
 
+    def to_record(self):
+        return (self.tags, [user.id for user in self.users], self.paused_users, json.dumps(self.pools),
+                self.is_private, self.guild.id if self.guild else None, self.channel.id if self.channel else None,
+                self.last_post_id)
 
 
+class SubscriptionIndex:
+    """
+    inverted index from tag to subscriptions, used to match the posts of the
+    global feed against every subscription locally instead of querying each one
+    """
 
+    def __init__(self, subscriptions, aliases=None):
+        self.tag_to_subs = dict()
+        self.queries = dict()
+        # tag aliases of the tag index, None while it isn't loaded
+        self.aliases = aliases
+        # subs with tags that only danbooru can resolve (metatags, wildcards, or-tags)
+        self.unindexed = list()
+        for sub in subscriptions:
+            self.add(sub)
+
+    @staticmethod
+    def parse_tags(tags, aliases=None):
+        """
+        splits tags into required tags, excluded tags, ratings and excluded ratings,
+        returns None if that isn't possible.
+        aliased tags are resolved to the names used in tag_string, without aliases nothing can be indexed
+        """
+        if aliases is None:
+            return None
+        required, excluded, ratings, excluded_ratings = set(), set(), set(), set()
+        for tag in tags:
+            tag = tag.lower()
+            negated = tag.startswith('-')
+            if negated:
+                tag = tag[1:]
+            if not tag or tag.startswith('~') or '*' in tag:
+                return None
+            prefix, _, value = tag.partition(':')
+            if value and prefix == 'rating':
+                values = {rating[0] for rating in value.split(',') if rating}
+                if negated:
+                    excluded_ratings.update(values)
+                else:
+                    ratings.update(values)
+            elif value and prefix in DANBOORU_METATAGS:
+                return None
+            elif negated:
+                excluded.add(aliases.get(tag, tag))
+            else:
+                required.add(aliases.get(tag, tag))
+        if not required:
+            return None
+        return required, excluded, ratings, excluded_ratings
 
+    def add(self, sub):
+        query = self.parse_tags(sub.tags, self.aliases)
+        if query is None:
+            self.unindexed.append(sub)
+            return
+        self.queries[sub] = query
+        # one key per sub is enough since every required tag has to be on the post
+        key = min(query[0])
+        self.tag_to_subs.setdefault(key, list()).append(sub)
+
+    def match(self, image):
+        """returns all indexed subs the post matches"""
+        post_tags = set(image['tag_string'].split())
+        matched = list()
+        for tag in post_tags:
+            for sub in self.tag_to_subs.get(tag, []):
+                required, excluded, ratings, excluded_ratings = self.queries[sub]
+                if not required <= post_tags or excluded & post_tags:
+                    continue
+                if ratings and image.get('rating') not in ratings:
+                    continue
+                if image.get('rating') in excluded_ratings:
+                    continue
+                matched.append(sub)
+        return matched
 
-    def sub_to_json(self):
-        ret_val = dict()
-        ret_val['users'] = {}
-        for counter, user in enumerate(self.users):
-            ret_val['users'][counter] = {}
-            ret_val['users'][counter]['id'] = user.id
-            ret_val['users'][counter]['name'] = user.name
-            ret_val['users'][counter]['mention'] = user.mention
-        ret_val['tags'] = self.tags
-        ret_val['is_private'] = self.is_private
-        if not self.is_private:
-            ret_val['server'] = self.guild.id
-            ret_val['channel'] = self.channel.id
-        ret_val['old_timestamp'] = str(self.old_timestamp)
-        ret_val['new_timestamp'] = str(self.new_timestamp)
-        ret_val['already_posted'] = self.already_posted
-        ret_val['pools'] = self.pools
-        ret_val['paused_users'] = []
-        for paused_user in self.paused_users:
-            ret_val['paused_users'].append(paused_user)
-        return json.dumps(ret_val, indent=2)
 
-    def write_sub_to_file(self):
-        content = self.sub_to_json()
-        with open(self.feed_file,'w') as file:
-            file.write(content)
+class DeliveryQueue:
+    """
+    outbound queue for subscription posts with one worker per channel or dm.
+    posts of several subs waiting for the same destination are merged into as few messages as possible,
+    so the poller never waits for discord
+    """
+    max_message_length = 2000
 
+    def __init__(self, bot):
+        self.bot = bot
+        self.logger = logging.getLogger('PoutyBot')
+        self.pending = dict()
+        self.destinations = dict()
+        self.workers = dict()
+        # kept across worker restarts, a new worker must not get a fresh burst
+        self.channel_buckets = dict()
+
+    def put(self, destination, sub, posts, post_id):
+        """:param post_id: newest post id in posts, becomes the sub's last_post_id once they were sent"""
+        self.pending.setdefault(destination.id, list()).append((sub, posts, post_id))
+        self.destinations[destination.id] = destination
+        worker = self.workers.get(destination.id)
+        if worker is None or worker.done():
+            self.workers[destination.id] = self.bot.loop.create_task(self._work(destination.id))
+
+    def _get_channel_bucket(self, destination_id):
+        # discord allows 5 messages per 5 seconds on a channel route
+        bucket = self.channel_buckets.get(destination_id)
+        if bucket is None:
+            bucket = TokenBucket(CHANNEL_MESSAGES_PER_SECOND, CHANNEL_MESSAGE_BURST)
+            self.channel_buckets[destination_id] = bucket
+        return bucket
+
+    async def _work(self, destination_id):
+        bucket = self._get_channel_bucket(destination_id)
+        try:
+            while self.pending.get(destination_id):
+                # everything queued while the last batch was sent is merged into the next one
+                batch = self.pending.pop(destination_id)
+                destination = self.destinations[destination_id]
+                failed_subs = set()
+                for message, subs in self.build_messages(batch):
+                    await bucket.acquire()
+                    try:
+                        await destination.send(message)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        # one broken message must not take the rest of the queue with it
+                        self.logger.exception(f"sending danbooru posts to {destination_id} failed")
+                        failed_subs.update(subs)
+                self.advance_watermarks(batch, failed_subs)
+        finally:
+            self.workers.pop(destination_id, None)
+
+    @staticmethod
+    def advance_watermarks(batch, failed_subs):
+        """moves last_post_id of the subs whose posts were all sent, the others find their posts again"""
+        for sub, _, post_id in batch:
+            if sub in failed_subs:
+                sub.queued_post_id = None
+            elif sub.last_post_id is None or post_id > sub.last_post_id:
+                sub.last_post_id = post_id
+                sub.dirty = True
+
+    def build_messages(self, batch):
+        """
+        merges the queued posts per sub and packs them into messages below discord's length limit,
+        returns every message with the subs that have posts in it
+        """
+        posts_per_sub = dict()
+        for sub, posts, _ in batch:
+            posts_per_sub.setdefault(sub, list()).extend(posts)
+        lines = list()
+        for sub, posts in posts_per_sub.items():
+            lines.append((sub, sub.users_to_mention()))
+            lines.append((sub, '`{}`'.format(sub.tags_to_message())))
+            lines += [(sub, post) for post in posts]
+        messages = list()
+        message = ''
+        subs = set()
+        for sub, line in lines:
+            line = line[:self.max_message_length - 1]
+            if len(message) + len(line) + 1 > self.max_message_length:
+                messages.append((message, subs))
+                message = ''
+                subs = set()
+            message += line + '\n'
+            subs.add(sub)
+        if message:
+            messages.append((message, subs))
+        return messages
+
+    async def close(self, timeout: float = DELIVERY_DRAIN_TIMEOUT):
+        """
+        sends what is still queued, workers that aren't done after timeout are cancelled.
+        their posts weren't marked as sent, so they are found again after the next start
+        """
+        workers = list(self.workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for worker in pending:
+            worker.cancel()
 
 
 class Scheduler:
-    def __init__(self, bot, session):
+    def __init__(self, bot, client, tag_index=None):
         self.bot = bot
-        self.session = session
+        self.client = client
+        # its aliases let the feed match subs that use aliased tags
+        self.tag_index = tag_index
         self.subscriptions = list()
-        self.auth_file = 'data/danbooru/danbooru.json'
         self.subs_file = 'data/danbooru/subs.db'
-        self.retrieve_subs()
-        self.helper = Helper(self.session, self.bot, self.auth_file)
+        self.delivery = DeliveryQueue(self.bot)
+        self.sub_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SUBS)
+        self.helper = Helper(self.client, self.bot)
         self.logger = logging.getLogger('discord')
+        self.settings_file = 'data/danbooru/scheduler_settings.json'
+        self.feed_mode = False
+        if os.path.exists(self.settings_file):
+            with open(self.settings_file) as f:
+                self.feed_mode = json.load(f).get('feed_mode', False)
+        self.last_feed_post_id = None
 
     @tasks.loop(minutes=1)
     async def schedule_task(self):
-        #iterate through all subscriptions and update information
-        subs_copy = self.subscriptions.copy()
-        for sub in subs_copy:
+        # update all subscriptions concurrently, the api bucket paces the requests
+        subs_copy = [sub for sub in self.subscriptions if not self._is_paused(sub)]
+        try:
+            if self.feed_mode:
+                await self._update_from_feed(subs_copy)
+            else:
+                await asyncio.gather(*[self._update_sub(sub) for sub in subs_copy])
+        finally:
+            await self.flush_dirty_subs()
+
+    @schedule_task.before_loop
+    async def before_schedule_task(self):
+        await self.bot.wait_until_ready()
+        await self.init_database()
+        await self.load_subs()
+
+    def set_feed_mode(self, feed_mode: bool):
+        self.feed_mode = feed_mode
+        self.last_feed_post_id = None
+        with open(self.settings_file, 'w') as f:
+            json.dump({'feed_mode': feed_mode}, f)
+
+    @staticmethod
+    def _is_paused(sub):
+        return sub.is_private and len(sub.paused_users) > 0 or len(sub.paused_users) == len(sub.users)
+
+    async def _update_from_feed(self, subs):
+        index = SubscriptionIndex(subs, self._aliases())
+        # subs the feed can't answer still get their own query
+        fallback = asyncio.gather(*[self._update_sub(sub) for sub in index.unindexed])
+        try:
+            images = await self._fetch_new_feed_posts(index.queries)
+            matched_posts = dict()
+            for image in images:
+                if not image.get('file_url'):
+                    continue
+                for sub in self.find_matching_subs(image, index):
+                    matched_posts.setdefault(sub, list()).append(image)
+            for sub, posts in matched_posts.items():
+                self._send_feed_matches(sub, posts)
+        finally:
+            await fallback
+
+    async def _fetch_new_feed_posts(self, subs):
+        """
+        follows the global post feed from the highest post id seen, returns the new posts.
+        after a start or a mode switch the feed resumes from the lowest watermark of subs,
+        at most MAX_FEED_PAGES pages behind the newest post, and catches up over the next ticks
+        """
+        if self.last_feed_post_id is None:
+            images = await self.helper.lookup_posts(limit=1)
+            if not images:
+                return []
+            newest_id = images[0]['id']
+            watermarks = [sub.watermark for sub in subs if sub.watermark is not None]
+            # subs without a watermark start from the newest post anyway
+            start = min(watermarks, default=newest_id)
+            self.last_feed_post_id = max(start, newest_id - MAX_FEED_PAGES * FEED_PAGE_SIZE)
+        new_images = []
+        for _ in range(MAX_FEED_PAGES):
+            images = await self.helper.lookup_posts(limit=FEED_PAGE_SIZE, page=f'a{self.last_feed_post_id}')
+            if not images:
+                break
+            new_images += images
+            self.last_feed_post_id = max(image['id'] for image in images)
+            if len(images) < FEED_PAGE_SIZE:
+                break
+        new_images.sort(key=lambda image: image['id'], reverse=True)
+        return new_images
+
+    def _send_feed_matches(self, sub, images):
+        if sub not in self.subscriptions:
+            return
+        new_posts = self._find_all_new_posts(images, sub)
+        if new_posts:
+            self.send_new_posts(sub, new_posts)
+
+    async def _update_sub(self, sub):
+        async with self.sub_semaphore:
             # skip the subscription if the sub was already removed
             if sub not in self.subscriptions:
-                continue
-            if sub.is_private and len(sub.paused_users) > 0 or len(sub.paused_users) == len(sub.users):
-                continue
+                return
             try:
                 images = await self.helper.lookup_tags(sub.tags_to_string())
                 if not images:
-                    continue
-                new_posts, timestamp_posted = await self._find_all_new_posts(images, sub)
+                    return
+                new_posts = self._find_all_new_posts(images, sub)
                 if new_posts:
-                    await self.send_new_posts(sub, new_posts)
-                    sub.old_timestamp = max(timestamp_posted)
-                    sub.write_sub_to_file()
-                await asyncio.sleep(30)
-
-            except asyncio.CancelledError as e:
-                self._write_subs_information_to_file()
+                    self.send_new_posts(sub, new_posts)
+            except asyncio.CancelledError:
                 raise
-            except aiohttp.ClientOSError as cle:
-                self._write_subs_information_to_file()
-                await asyncio.sleep(10)
-                continue
+            except aiohttp.ClientOSError:
+                pass
             except Exception as e:
                 owner = self.bot.get_user(134310073014026242)
-                self._write_subs_information_to_file()
                 message = ('Error during update Task: `{}`\n'
                            'during Sub: `{}`\n'
                            '```\n{}\n```'
-                           .format(repr(e),sub.tags_to_string(),traceback.print_exc()))
+                           .format(repr(e), sub.tags_to_string(), traceback.format_exc()[-1500:]))
                 await owner.send(message)
-                await asyncio.sleep(10)
-                continue
-        self.write_to_file()
 
     def cancel_task(self):
         self.schedule_task.cancel()
 
-    def _write_subs_information_to_file(self):
-        self.write_to_file()
-        for subscription in self.subscriptions:
-            subscription.write_sub_to_file()
+    async def shutdown(self):
+        """drains the delivery queue and writes the watermarks of what was sent"""
+        await self.delivery.close()
+        await self.flush_dirty_subs()
 
-    async def _find_all_new_posts(self, images, sub):
-        new_posts = list()
-        timestamp_posted = list()
+    def _find_all_new_posts(self, images, sub):
+        """
+        returns the file urls of all posts newer than the watermark of the sub and moves its queued_post_id,
+        last_post_id is only moved by the delivery queue once the posts were sent
+        """
         if not images:
+            return []
+        newest_id = max(image['id'] for image in images)
+        watermark = sub.watermark
+        if watermark is None:
+            # nothing was sent for this sub yet, start from the newest post
+            sub.last_post_id = newest_id
+            sub.dirty = True
+            return []
+        new_posts = [image['file_url'] for image in images
+                     if image['id'] > watermark and image.get('file_url')]
+        if newest_id > watermark:
+            sub.queued_post_id = newest_id
+        return new_posts
+
+    async def init_database(self):
+        query = '''
+            CREATE TABLE IF NOT EXISTS danbooru_subs(
+                sub_id SERIAL PRIMARY KEY,
+                tags TEXT[] NOT NULL,
+                users BIGINT[] NOT NULL,
+                paused_users BIGINT[] NOT NULL DEFAULT '{}',
+                pools TEXT NOT NULL DEFAULT '[]',
+                is_private BOOLEAN NOT NULL,
+                guild_id BIGINT,
+                channel_id BIGINT,
+                last_post_id BIGINT
+            )
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query)
+
+    async def load_subs(self):
+        async with self.bot.db.acquire() as con:
+            rows = await con.fetch("SELECT * FROM danbooru_subs")
+        if not rows and os.path.exists(self.subs_file):
+            await self.migrate_subs_from_files()
             return
-        for image in images:
-            created = parser.parse(image['created_at'])
-            if not sub.old_timestamp:
-                sub.old_timestamp = created
-                await self.send_new_posts(sub,[image['file_url']])
-                sub.write_sub_to_file()
-            if created > sub.old_timestamp:
-                new_posts.append(image['file_url'])
-                timestamp_posted.append(created)
-        return new_posts,timestamp_posted
-
-    def retrieve_subs(self):
-        if not os.path.exists(self.subs_file):
-            open(self.subs_file,'w').close()
+        for row in rows:
+            sub = self.create_sub_from_row(row)
+            if sub is None:
+                continue
+            self.subscriptions.append(sub)
+
+    def _get_sub_channel(self, guild_id, channel_id):
+        if os.path.exists('data/danbooru/sub_channel.json'):
+            with open('data/danbooru/sub_channel.json', 'r') as f:
+                sub_channel_file = json.load(f)
+            guild_id = sub_channel_file['server']
+            channel_id = sub_channel_file['channel']
+        return self.bot.get_guild(int(guild_id)), self.bot.get_channel(int(channel_id))
+
+    def create_sub_from_row(self, row):
+        user_list = []
+        server, channel = None, None
+        if row['is_private']:
+            user = self.bot.get_user(row['users'][0])
+            if user is None:
+                return None
+            user_list.append(user)
+        else:
+            server, channel = self._get_sub_channel(row['guild_id'], row['channel_id'])
+            if server is None:
+                return None
+            for user_id in row['users']:
+                member = server.get_member(user_id)
+                if member is None:
+                    continue
+                user_list.append(member)
+        return Dansub(user_list, list(row['tags']), json.loads(row['pools']), server, channel, row['is_private'],
+                      list(row['paused_users']), sub_id=row['sub_id'], last_post_id=row['last_post_id'])
+
+    async def insert_sub(self, sub):
+        query = '''
+            INSERT INTO danbooru_subs (tags, users, paused_users, pools, is_private, guild_id, channel_id, last_post_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING sub_id
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                sub.sub_id = await con.fetchval(query, *sub.to_record())
+        sub.dirty = False
+
+    async def save_sub(self, sub):
+        """writes the row of a single sub right away"""
+        sub.dirty = True
+        await self.flush_dirty_subs([sub])
+
+    async def flush_dirty_subs(self, subs=None):
+        """writes only the rows of subs that changed since they were last written"""
+        subs = subs if subs is not None else self.subscriptions
+        dirty_subs = [sub for sub in subs if sub.dirty and sub.sub_id is not None]
+        if not dirty_subs:
+            return
+        query = '''
+            UPDATE danbooru_subs SET users = $2, paused_users = $3, last_post_id = $4 WHERE sub_id = $1
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.executemany(query, [(sub.sub_id, [user.id for user in sub.users], sub.paused_users,
+                                               sub.last_post_id) for sub in dirty_subs])
+        for sub in dirty_subs:
+            sub.dirty = False
+
+    async def delete_sub(self, sub):
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute("DELETE FROM danbooru_subs WHERE sub_id = $1", sub.sub_id)
+
+    async def migrate_subs_from_files(self):
+        """
+        imports the old one json file per sub storage into the database in one transaction,
+        the subs file is only renamed once it committed so an interrupted migration starts over cleanly
+        """
         with open(self.subs_file) as f:
             lines = f.readlines()
+        subs = []
         for line in lines:
-            line = line.replace('\n','')
-            line = line.replace('\'','')
+            line = line.replace('\n', '')
+            line = line.replace('\'', '')
+            if not line or not os.path.exists(line):
+                continue
             sub = self.create_sub_from_file(line)
-            if sub == None:
+            if sub is None:
                 continue
-            print(sub.tags_to_string())
-            self.subscriptions.append(sub)
+            subs.append(sub)
+        query = '''
+            INSERT INTO danbooru_subs (tags, users, paused_users, pools, is_private, guild_id, channel_id, last_post_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING sub_id
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                for sub in subs:
+                    sub.sub_id = await con.fetchval(query, *sub.to_record())
+        os.rename(self.subs_file, self.subs_file + '.migrated')
+        self.subscriptions += subs
 
     def create_sub_from_file(self,json_path):
         with open(json_path) as sub_file:
@@ -281,94 +876,40 @@ class Scheduler:
         if 'is_private' in data and bool(data['is_private']):
             is_private = True
             id = data['users']['0']['id']
-            name = data['users']['0']['name']
             user = self.bot.get_user(id)
             if user is None:
                 return None
             user_list.append(user)
+            server, channel = None, None
         else:
             is_private = False
-            if os.path.exists('data/danbooru/sub_channel.json'):
-                with open('data/danbooru/sub_channel.json','r') as f:
-                    sub_channel_file = json.load(f)
-                server = self.bot.get_guild(int(sub_channel_file['server']))
-                channel = self.bot.get_channel(int(sub_channel_file['channel']))
-            else:
-                server = self.bot.get_guild(int(data['server']))
-                channel = self.bot.get_channel(int(data['channel']))
+            server, channel = self._get_sub_channel(data['server'], data['channel'])
             for user in data['users']:
                 # try to get the member through Discord and their ID
                 member = server.get_member(int(data['users'][user]['id']))
-                # if that fails create own user with the necessary information
                 if member == None:
                     continue
                 user_list.append(member)
 
         tags = data['tags']
-        timestamp = data['old_timestamp']
-        if 'paused_users' in data:
-            paused_users = data['paused_users']
-        else:
-            paused_users = []
-        if 'pools' in data:
-            pools = data['pools']
-        else:
-            pools = []
-        if is_private:
-            retrieved_sub = Dansub(user_list, tags, pools, None, None, is_private, paused_users)
-        else:
-            retrieved_sub = Dansub(user_list, tags, pools, server, channel, is_private, paused_users)
-        if timestamp != 'None':
-            retrieved_sub.old_timestamp = parser.parse(timestamp)
-        return retrieved_sub
-
-    async def send_new_posts(self, sub, new_posts):
-        message_list = self._split_message_in_groups_of_four(sub, new_posts)
-        for partial_message in message_list:
-            if sub.is_private:
-                await sub.users[0].send(partial_message)
-            else:
-                await sub.channel.send(partial_message)
-            await asyncio.sleep(10)
-
-    def find_matching_subs(self, tags, subs, image):
-        matched_subs = list()
-        for sub in subs:
-            if sub.tags_to_string() in image['tag_string']:
-                matched_subs.append(sub.users)
-        return matched_subs
-
-    def _split_message_in_groups_of_four(self, sub, new_posts):
-        message_list = []
-        message = ('{}\n'
-                   '`{}`\n'
-                   .format(sub.users_to_mention(),sub.tags_to_message()))
-        for index, post in enumerate(new_posts,1):
-            if index%4 == 0:
-                if post is new_posts[-1]:
-                    break
-                message_list.append(message)
-
-                message = ""
-            message += post + "\n"
-        message += ('`{}`'.format(sub.tags_to_message()))
-        message_list.append(message)
-        return message_list
-
-
-    def _reduce_message_spam(self, sub, new_posts):
-        message_list = []
-        message = ('{}\n'
-                   '`{}`\n'
-                   .format(sub.users_to_mention(),sub.tags_to_message()))
-        for post in new_posts:
-            if len(message + post + '\n') > 2000:
-                message_list.append(message)
-                message = ""
-            message += post+'\n'
-        message_list.append(message)
-        return message_list
+        paused_users = data.get('paused_users', [])
+        pools = data.get('pools', [])
+        # the old files only know timestamps, the watermark starts at the newest post on the first update
+        return Dansub(user_list, tags, pools, server, channel, is_private, paused_users)
+
+    def send_new_posts(self, sub, new_posts):
+        destination = sub.users[0] if sub.is_private else sub.channel
+        self.delivery.put(destination, sub, new_posts, sub.queued_post_id)
+
+    def _aliases(self):
+        if self.tag_index is None or not self.tag_index.loaded:
+            return None
+        return self.tag_index.aliases
 
+    def find_matching_subs(self, image, index=None):
+        if index is None:
+            index = SubscriptionIndex(self.subscriptions, self._aliases())
+        return index.match(image)
 
     def sort_tags(self, image):
         tags = image['tag_string'].split(' ')
@@ -376,15 +917,6 @@ class Scheduler:
         sorted_tags = ' '.join(tags)
         image['tag_string'] = sorted_tags
 
-    def write_to_file(self):
-        try:
-            subscriptions = '\n'.join(sub.feed_file for sub in self.subscriptions)
-            with open(self.subs_file, 'w') as f:
-                f.write(subscriptions)
-        except Exception as e:
-            print(e)
-            raise e
-
 
 
 class Danbooru(commands.Cog):
@@ -393,12 +925,22 @@ class Danbooru(commands.Cog):
     """
     def __init__(self, bot):
         self.bot = bot
-        self.auth_file = 'data/danbooru/danbooru.json'
-        self.session = aiohttp.ClientSession()
-        self.scheduler = Scheduler(self.bot,self.session)
+        self.client = get_client(self.bot)
+        self.tag_index = TagIndex()
+        self.scheduler = Scheduler(self.bot, self.client, self.tag_index)
         self.running_task = self.scheduler.schedule_task.start()
-        self.helper = Helper(self.session,self.bot,self.auth_file)
+        self.caches = {
+            'posts': AsyncTTLCache(maxsize=512, ttl=60),
+            'tags': AsyncTTLCache(maxsize=256, ttl=3600),
+            'wiki': AsyncTTLCache(maxsize=256, ttl=86400),
+        }
+        self.helper = Helper(self.client, self.bot, self.caches['posts'])
+        self.logger = logging.getLogger('PoutyBot')
         self.init_directories()
+        self.refresh_tag_index.start()
+        # (requester id, bot message id) of the last images sent per channel
+        self.sent_images = dict()
+        self.bot.loop.create_task(self.init_undo_history())
         self.blacklist_tags_file = 'data/danbooru_cog_blacklist.json'
         self.danbooru_channel_file = 'data/danbooru_channel_file.json'
         self.bucket = commands.CooldownMapping.from_cooldown(1, 60, commands.BucketType.member)
@@ -413,31 +955,92 @@ class Danbooru(commands.Cog):
     def cog_unload(self):
         try:
             self.running_task.cancel()
-            if not self.scheduler.subscriptions:
-                return
-            self.scheduler.write_to_file()
-            for sub in self.scheduler.subscriptions:
-                sub.write_sub_to_file()
-                del sub
-            self.bot.loop.create_task(self.session.close())
+            self.refresh_tag_index.cancel()
+            self.bot.loop.create_task(self.scheduler.shutdown())
             del self.scheduler
         except Exception as e:
             print(e)
             raise e
 
+    @tasks.loop(hours=1)
+    async def refresh_tag_index(self):
+        try:
+            if not self.tag_index.loaded:
+                await self.tag_index.load()
+            if self.tag_index.is_fresh(TAG_INDEX_MAX_AGE):
+                return
+            await self.tag_index.refresh(self.client)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, EOFError, ValueError, KeyError):
+            # ValueError covers broken json answers and broken lines in the files on disk
+            self.logger.exception("refreshing the danbooru tag index failed")
+
+    def _build_suggestion_message(self, unknown_tags):
+        lines = []
+        for tag in unknown_tags:
+            suggestions = self.tag_index.suggest(tag)
+            tag = discord.utils.escape_markdown(tag)
+            if suggestions:
+                suggestions = ', '.join(f"`{suggestion}`" for suggestion in suggestions)
+                lines.append(f"tag `{tag}` not found, did you mean: {suggestions}")
+            else:
+                lines.append(f"tag `{tag}` not found, use the `dantag` command with part of the name to find it")
+        return '\n'.join(lines)
+
     def init_directories(self):
         if not os.path.exists('data/danbooru'):
             os.mkdir('data/danbooru')
-        if not os.path.exists('data/danbooru/subs/'):
-            os.mkdir('data/danbooru/subs')
-        if not os.path.exists(self.auth_file):
+        if not os.path.exists(self.client.auth_file):
             print('authentication file is missing')
 
-    def _add_blacklist_to_tags(self, tags):
-        if self.tags_blacklist:
-            blacklist = ' -'+' -'.join(self.tags_blacklist)
-            tags += blacklist
-        return tags
+    @staticmethod
+    def _uses_tag_slot(tag):
+        prefix, _, value = tag.lstrip('-~').partition(':')
+        return not (value and prefix in DANBOORU_UNLIMITED_METATAGS)
+
+    def _plan_query(self, tags, tag_limit):
+        """
+        adds as many blacklisted tags as the account's tag limit allows to the query.
+        returns the query, the blacklisted tags that have to be filtered out of the results locally
+        and the blacklisted tags that neither fit into the query nor can be checked locally.
+        if the last list isn't empty the query must not be sent
+        """
+        free_slots = tag_limit - len([tag for tag in tags.split() if self._uses_tag_slot(tag)])
+        free = []
+        server_side = []
+        local = []
+        for tag in self.tags_blacklist:
+            prefix, _, value = tag.partition(':')
+            if not self._uses_tag_slot(tag):
+                # don't count against the limit, always sent
+                free.append(tag)
+            elif '*' in tag or (value and prefix in DANBOORU_METATAGS):
+                # metatags and wildcards can't be checked locally, they get the slots first
+                server_side.append(tag)
+            else:
+                local.append(tag)
+        if self.tag_index.loaded:
+            # the most used tags would filter the most results, so danbooru should handle those
+            local.sort(key=lambda tag: (self.tag_index.lookup(tag) or (0, 0))[1], reverse=True)
+        candidates = server_side + local
+        sent = candidates[:max(free_slots, 0)]
+        unsendable = [tag for tag in server_side if tag not in sent]
+        sent = free + sent
+        if sent:
+            tags += ' -' + ' -'.join(sent)
+        return tags, [tag for tag in local if tag not in sent], unsendable
+
+    @staticmethod
+    def _build_blacklist_filter(blacklist):
+        if not blacklist:
+            return None
+        ratings = {tag.partition(':')[2][:1] for tag in blacklist if tag.startswith('rating:')}
+        blacklist = set(blacklist)
+
+        def is_allowed(image):
+            if image.get('rating') in ratings:
+                return False
+            return not blacklist.intersection(image['tag_string'].split())
+        return is_allowed
 
     @checks.is_owner_or_moderator()
     @commands.group(pass_context=True, aliases=['danbl'])
@@ -512,15 +1115,28 @@ class Danbooru(commands.Cog):
             channel = self._get_danbooru_channel_of_message(message)
             if channel is None:
                 await ctx.send("danbooru channel not setup")
-                return
+                return None, None
         else:
             channel = ctx.message.channel
-        tags = self._add_blacklist_to_tags(tags)
+        query = tags
+        tags, local_blacklist, unsendable = self._plan_query(tags, await self.client.tag_query_limit())
+        if unsendable:
+            # those can't be filtered out of the results here, the search would ignore the blacklist
+            await ctx.send("too many tags to also exclude the blacklisted tags "
+                           f"{', '.join(f'`{tag}`' for tag in unsendable)}, please search with fewer tags")
+            return None, None
+        is_allowed = self._build_blacklist_filter(local_blacklist)
         if random:
-            image = await self.helper.lookup_tags(tags, limit='1', random=random)
+            image = await self.helper.lookup_random(tags, is_allowed)
         else:
-            image = await self.helper.lookup_tags(tags, limit='1')
-        if len(image) == 0:
+            image = await self.helper.lookup_newest(tags, is_allowed)
+        if not image:
+            # tags created since the last refresh of the index are missing from it, so it is only asked
+            # once danbooru found nothing
+            unknown_tags = self.tag_index.unknown_tags(query) if self.tag_index.loaded else None
+            if unknown_tags:
+                await ctx.send(self._build_suggestion_message(unknown_tags))
+                return None, None
             await ctx.send("no image found please refer to the pin:\n"
                            "https://discordapp.com/channels/187423852224053248/402151326915493888/582629178285883394\n"
                            "or use the `dantag` command with part of the character or franchise name to see how it"
@@ -537,31 +1153,47 @@ class Danbooru(commands.Cog):
                 .dantag fate copyright (to search franchises containing the name 'fate')
            """
         types = {0: "general",  1: "artist",  3: "copyright", 4: "character", 5: "meta"}
-        url = f"https://danbooru.donmai.us/tags.json?search[hide_empty]=yes&search[order]=count&search[name_matches]=*{tag}*"
+        if self.tag_index.loaded:
+            found_tags = await self.tag_index.search(tag, category)
+            if not found_tags:
+                await ctx.send(self._build_suggestion_message([tag]))
+                return
+            entries = [(f"{discord.utils.escape_markdown(name)} [{types.get(tag_category, 'unknown')}]",
+                        f"{count} posts") for name, tag_category, count in found_tags]
+            pages = FieldPages(ctx, entries=entries, per_page=5)
+            await pages.paginate()
+            return
+        url = f"/tags.json?search[hide_empty]=yes&search[order]=count&search[name_matches]=*{tag}*"
         if category:
             url += f"&search[category]={category}"
         entries = []
-        async with self.session.get(url) as resp:
-            if resp.status == 200:
-                info = (await resp.json())
-                for tag in info:
-                    related_tags = tag.get('related_tags', '')
-                    tag_name = tag.get('name', None)
-                    value = '\u200b'
-                    if related_tags:
-                        related_tags_list = related_tags.split()
-                        related_tags_list = [t for t in related_tags_list if not t.isdigit()]
-                        related_tags_list = [t for t in related_tags_list if not re.fullmatch(r'\d+\.\d+', t)]
-                        if tag_name in related_tags_list:
-                            related_tags_list.remove(tag_name)
-                        related_tags = ', '.join(related_tags_list)
-                        related_tags = discord.utils.escape_markdown(related_tags)
-                        value = f"**related tags**: {related_tags}"
-                    tag_name = discord.utils.escape_markdown(tag_name)
-                    key = f"{tag_name} [{types[tag['category']]}]"
-                    entries.append((key, value))
-                pages = FieldPages(ctx, entries=entries, per_page=5)
-                await pages.paginate()
+        info = await self.caches['tags'].get_or_fetch(url, lambda: self._fetch_json(url))
+        for tag in info:
+            related_tags = tag.get('related_tags', '')
+            tag_name = tag.get('name', None)
+            value = '\u200b'
+            if related_tags:
+                related_tags_list = related_tags.split()
+                related_tags_list = [t for t in related_tags_list if not t.isdigit()]
+                related_tags_list = [t for t in related_tags_list if not re.fullmatch(r'\d+\.\d+', t)]
+                if tag_name in related_tags_list:
+                    related_tags_list.remove(tag_name)
+                related_tags = ', '.join(related_tags_list)
+                related_tags = discord.utils.escape_markdown(related_tags)
+                value = f"**related tags**: {related_tags}"
+            tag_name = discord.utils.escape_markdown(tag_name)
+            key = f"{tag_name} [{types[tag['category']]}]"
+            entries.append((key, value))
+        pages = FieldPages(ctx, entries=entries, per_page=5)
+        await pages.paginate()
+
+    async def _fetch_json(self, url):
+        async with self.client.get(url) as resp:
+            if resp.status == 404:
+                raise commands.CommandError("tag not found")
+            if resp.status != 200:
+                raise commands.CommandError(f"Danbooru replied with following code: {resp.status}")
+            return await resp.json()
 
 
 
@@ -576,46 +1208,98 @@ class Danbooru(commands.Cog):
         channel, send_message = await self._find_danbooru_image(ctx, tags, random=None)
         if channel is None or send_message is None:
             return
-        await channel.send(send_message)
+        sent_message = await channel.send(send_message)
+        await self._remember_sent_image(ctx.author, sent_message)
 
     @dan.command(name="def", aliases=["definition", "wiki"])
     async def def_(self, ctx, tag):
-        async with self.session.get(f"https://danbooru.donmai.us/wiki_pages.json?search[title]={tag}") as resp:
-            if resp.status == 200:
-                info = (await resp.json())[0]
-                title = info.get("title", tag)
-                description = info.get("body")
-                description_clean = discord.utils.escape_markdown(description)
-                embed = discord.Embed(title=title,
-                                      url=f"https://danbooru.donmai.us/wiki_pages?title={title}",
-                                      description=f"{description_clean[:2040]}..."
-                                      )
-                if info.get("other_names", None):
-                    embed.add_field(name="Other Names", value="\n".join(info["other_names"]))
-                await ctx.send(embed=embed)
-            elif resp.status == 404:
-                await ctx.send("tag not found")
-            else:
-                await ctx.send(f"Danbooru replied with following code: {resp.status}")
-
+        url = f"/wiki_pages.json?search[title]={tag}"
+        pages = await self.caches['wiki'].get_or_fetch(url, lambda: self._fetch_json(url))
+        if not pages:
+            await ctx.send("tag not found")
+            return
+        info = pages[0]
+        title = info.get("title", tag)
+        description = info.get("body")
+        description_clean = discord.utils.escape_markdown(description)
+        embed = discord.Embed(title=title,
+                              url=f"https://danbooru.donmai.us/wiki_pages?title={title}",
+                              description=f"{description_clean[:2040]}..."
+                              )
+        if info.get("other_names", None):
+            embed.add_field(name="Other Names", value="\n".join(info["other_names"]))
+        await ctx.send(embed=embed)
 
     @commands.command(name="danu", aliases=["danundo", "dundo", "dan_undo", "danremove", "danrm"])
     async def dan_undo(self, ctx, number: typing.Optional[int]):
         """removes the last image or the last x images you requested from the bot"""
         if ctx.channel.id not in [d["channel"] for d in self.danbooru_channels]:
             await ctx.send("Please use the command in the danbooru channel")
-        deleted_counter = 0
-        messages = await ctx.channel.history(limit=100, before=ctx.message).flatten()
-        to_delete = []
-        for index, message in enumerate(messages):
-            if message.author.id == ctx.author.id and "donmai" in messages[index -1].content:
-                to_delete.append(messages[index-1])
-                deleted_counter += 1
-                if not number and deleted_counter == 1:
-                    break
-                elif number <= deleted_counter:
-                    break
-        await ctx.channel.delete_messages(to_delete)
+            return
+        history = self.sent_images.get(ctx.channel.id, [])
+        to_delete = [entry for entry in reversed(history) if entry[0] == ctx.author.id][:number or 1]
+        if not to_delete:
+            return
+        for entry in to_delete:
+            history.remove(entry)
+        message_ids = [message_id for _, message_id in to_delete]
+        try:
+            await ctx.channel.delete_messages([discord.Object(id=message_id) for message_id in message_ids])
+        except discord.NotFound:
+            pass
+        except discord.HTTPException:
+            # bulk deletes are refused for messages older than two weeks, those can still be deleted one by one
+            for message_id in message_ids:
+                try:
+                    await ctx.channel.get_partial_message(message_id).delete()
+                except discord.NotFound:
+                    pass
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute("DELETE FROM danbooru_requests WHERE message_id = any($1::bigint[])", message_ids)
+
+    async def init_undo_history(self):
+        query = '''
+            CREATE TABLE IF NOT EXISTS danbooru_requests(
+                message_id BIGINT PRIMARY KEY,
+                channel_id BIGINT NOT NULL,
+                requester_id BIGINT NOT NULL,
+                created timestamp NOT NULL
+            )
+        '''
+        # discord only bulk deletes messages younger than two weeks
+        oldest = datetime.datetime.utcnow() - datetime.timedelta(days=14)
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query)
+                await con.execute("DELETE FROM danbooru_requests WHERE created < $1", oldest)
+            rows = await con.fetch("SELECT * FROM danbooru_requests ORDER BY message_id")
+        for row in rows:
+            self._get_undo_history(row['channel_id']).append((row['requester_id'], row['message_id']))
+
+    def _get_undo_history(self, channel_id):
+        history = self.sent_images.get(channel_id)
+        if history is None:
+            history = deque(maxlen=UNDO_HISTORY_SIZE)
+            self.sent_images[channel_id] = history
+        return history
+
+    async def _remember_sent_image(self, requester, message):
+        # .danu only works in the danbooru channels, images sent in dms can't be undone
+        if message.guild is None:
+            return
+        self._get_undo_history(message.channel.id).append((requester.id, message.id))
+        query = "INSERT INTO danbooru_requests VALUES ($1, $2, $3, $4)"
+        # keeps the table as small as the in memory history
+        trim_query = '''
+            DELETE FROM danbooru_requests WHERE channel_id = $1 AND message_id NOT IN (
+                SELECT message_id FROM danbooru_requests WHERE channel_id = $1 ORDER BY message_id DESC LIMIT $2
+            )
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query, message.id, message.channel.id, requester.id, message.created_at)
+                await con.execute(trim_query, message.channel.id, UNDO_HISTORY_SIZE)
 
     @commands.command(pass_context=True)
     async def danr(self, ctx, *, tags: str = ""):
@@ -626,7 +1310,8 @@ class Danbooru(commands.Cog):
         channel, send_message = await self._find_danbooru_image(ctx, tags, random="true")
         if channel is None or send_message is None:
             return
-        await channel.send(send_message)
+        sent_message = await channel.send(send_message)
+        await self._remember_sent_image(ctx.author, sent_message)
 
 
     @commands.group(pass_context=True, hidden=True)
@@ -648,7 +1333,6 @@ class Danbooru(commands.Cog):
         if not resp:
             await ctx.send("Error while looking up tag. Try again or correct your tags.")
             return
-        timestamp = parser.parse(resp[0]['created_at'])
         tags_list = tags.split(' ')
         pool_list = []
         for tag in tags_list:
@@ -670,7 +1354,7 @@ class Danbooru(commands.Cog):
                     if sub.is_private or is_private:
                         break
                     sub.users.append(message.author)
-                    sub.write_sub_to_file()
+                    await self.scheduler.save_sub(sub)
                     await ctx.send('{}\nSuccessfully added to existing sub `{}`'.format(ctx.message.author.mention,sub.tags_to_message()))
                     return
             if os.path.exists('data/danbooru/sub_channel.json'):
@@ -682,9 +1366,9 @@ class Danbooru(commands.Cog):
             else:
                 new_sub = Dansub(message.author, tags_list, pool_list, message.guild, message.channel,is_private)
 
-            new_sub.old_timestamp = timestamp
+            new_sub.last_post_id = resp[0]['id']
+            await self.scheduler.insert_sub(new_sub)
             self.scheduler.subscriptions.append(new_sub)
-            new_sub.write_sub_to_file()
         except Exception as e:
             await ctx.send('Error while adding sub `{}`'.format(repr(e)))
             raise e
@@ -708,8 +1392,8 @@ class Danbooru(commands.Cog):
                            try:
                                 user_unsubscribed = True
                                 sub.users.remove(user)
-                                self.scheduler.write_to_file()
-                                sub.write_sub_to_file()
+                                if sub.users:
+                                    await self.scheduler.save_sub(sub)
                                 await ctx.send("successfully unsubscribed")
                            except Exception as e:
                                await ctx.send('Error while unsubscribing: `{}`'.format(repr(e)))
@@ -719,10 +1403,10 @@ class Danbooru(commands.Cog):
                 if not sub.users:
                     try:
                         self.scheduler.subscriptions.remove(sub)
-                        os.remove(sub.feed_file)
+                        await self.scheduler.delete_sub(sub)
                         await ctx.send('subscription fully removed')
                     except Exception as e:
-                        await ctx.send('Error while removing feed file. `{}`'.format(repr(e)))
+                        await ctx.send('Error while removing subscription. `{}`'.format(repr(e)))
 
     @dans.command(pass_context=True)
     async def pause(self, ctx):
@@ -733,7 +1417,8 @@ class Danbooru(commands.Cog):
         subscriptions_of_user = [sub for sub in self.scheduler.subscriptions if subscriber in sub.users]
         for subscription in subscriptions_of_user:
             subscription.paused_users.append(subscriber.id)
-            subscription.write_sub_to_file()
+            subscription.dirty = True
+        await self.scheduler.flush_dirty_subs(subscriptions_of_user)
         await ctx.send("paused all of your subscriptions")
 
     @dans.command(pass_context=True)
@@ -745,7 +1430,8 @@ class Danbooru(commands.Cog):
         subscriptions_of_user = [sub for sub in self.scheduler.subscriptions if subscriber in sub.users]
         for subscription in subscriptions_of_user:
             subscription.paused_users.remove(int(subscriber.id))
-            subscription.write_sub_to_file()
+            subscription.dirty = True
+        await self.scheduler.flush_dirty_subs(subscriptions_of_user)
         await ctx.send("unpaused all of your subscriptions")
 
     @dans.command(pass_context=True)
@@ -791,13 +1477,38 @@ class Danbooru(commands.Cog):
 
                     tags = sub[0]
                     tags = tags.split(' ')
-                    dansub = Dansub(userlist,tags,server,channel)
-                    dansub.old_timestamp = parser.parse(sub[4])
+                    dansub = Dansub(userlist, tags, [], server, channel, False)
+                    await self.scheduler.insert_sub(dansub)
                     self.scheduler.subscriptions.append(dansub)
-                    dansub.write_sub_to_file()
-                self.scheduler.write_to_file()
 
 
+    @dans.command(hidden=True)
+    @checks.is_owner()
+    async def mode(self, ctx, mode: str = None):
+        """
+        switch between querying every sub (query) and matching the global post feed (feed)
+        """
+        if mode not in ('query', 'feed'):
+            current = 'feed' if self.scheduler.feed_mode else 'query'
+            await ctx.send(f'current mode: `{current}`, use `.dans mode query` or `.dans mode feed` to change it')
+            return
+        self.scheduler.set_feed_mode(mode == 'feed')
+        await ctx.send(f'subscriptions now use the `{mode}` mode')
+
+    @dans.command(name="cache", hidden=True)
+    @checks.is_owner()
+    async def cache_stats(self, ctx):
+        """shows how many danbooru requests the response caches saved"""
+        lines = []
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            saved = stats['hits'] + stats['coalesced']
+            total = saved + stats['misses']
+            ratio = saved / total * 100 if total else 0
+            lines.append(f"{name}: {stats['size']} entries, {stats['hits']} hits, {stats['coalesced']} coalesced, "
+                         f"{stats['misses']} misses ({ratio:.1f}% of requests saved)")
+        await ctx.send("```\n" + "\n".join(lines) + "```")
+
     @dans.command(hidden=True, pass_context=True)
     @checks.is_owner()
     async def setup(self, ctx):
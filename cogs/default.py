@@ -4,6 +4,7 @@ from .utils.exceptions import *
 from .utils import checks
 from .utils.dataIO import DataIO
 from .utils import paginator
+from .utils.message_scanner import get_scanner
 from discord.ext.commands import DefaultHelpCommand
 import traceback
 
@@ -119,6 +120,9 @@ class Default(commands.Cog):
         handler = logging.FileHandler(filename='data/dms.log', encoding='utf-8', mode='a')
         handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
         self.dm_logger.addHandler(handler)
+        self.scanner = get_scanner(bot)
+        self.scanner.register("dm_log", self.log_direct_message,
+                              check=lambda message: isinstance(message.channel, discord.DMChannel))
 
     def cog_unload(self):
         self.bot.remove_listener(self.on_ready, 'on_ready')
@@ -126,6 +130,7 @@ class Default(commands.Cog):
         self.bot.remove_check(self.check_for_black_list_user, call_once=True)
         self.bot.remove_check(self.check_disabled_command, call_once=True)
         self.bot.help_command = self._original_help_command
+        self.scanner.unregister("dm_log")
 
     async def on_ready(self):
         print('Logged in as')
@@ -141,11 +146,9 @@ class Default(commands.Cog):
                 print('Failed to load extension {}\n{}: {}'.format(extension, type(e).__name__, e))
                 continue
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if isinstance(message.channel, discord.DMChannel):
-            user = message.author
-            self.dm_logger.info(f"{user.name}#{user.discriminator}({user.id}) message: {message.content}")
+    async def log_direct_message(self, message, match):
+        user = message.author
+        self.dm_logger.info(f"{user.name}#{user.discriminator}({user.id}) message: {message.content}")
 
     async def on_command_error(self, ctx, error):
         self.logger.error(error, exc_info=True)
@@ -1,26 +1,59 @@
-from discord import File, PartialEmoji, Member
+from discord import File, PartialEmoji, Member, User
 from discord.ext import commands
 from typing import Optional, Union
-import aiohttp
-import asyncio
+from .utils.imaging import ImagePipeline, ResultCache
+from .utils.media import fetch_media, MediaError
+from .utils.http import get_session
 import io
-import uuid
-import os
-import sys
-import uuid
+
 
 class Distort(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-        self.allowed_file_extensions = ['png', 'jpg', 'jpeg', 'gif']
-        if 'win32' in sys.platform:
-            self.image_magick_command = "magick"
-        else:
-            self.image_magick_command = "convert"
+        self.session = get_session(bot)
+        self.allowed_types = ('image/png', 'image/jpeg', 'image/gif')
+        self.pipeline = ImagePipeline()
+        self.cache = ResultCache()
 
     def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
+        self.pipeline.close()
+
+    async def read_image(self, ctx, link):
+        """
+        downloads the image the command refers to into memory
+        :return: image bytes, None if there is no usable image
+        """
+        if ctx.message.attachments:
+            url = str(ctx.message.attachments[0].url)
+        elif isinstance(link, PartialEmoji):
+            return await link.url.read()
+        elif isinstance(link, (Member, User)):
+            return await self.avatar_asset(link).read()
+        else:
+            url = link
+        try:
+            media = await fetch_media(self.session, url, allowed=self.allowed_types)
+        except MediaError as e:
+            await ctx.send(f"{e} This command works with custom emojis, png, jpg or gif images and "
+                           f"usernames or mentions.")
+            return None
+        return media.data
+
+    @staticmethod
+    def avatar_asset(member):
+        if member.is_avatar_animated():
+            return member.avatar_url_as(format="gif")
+        return member.avatar_url_as(format="png")
+
+    def asset_url(self, ctx, link):
+        """discord cdn urls of emojis and avatars change with their content, so they identify the image"""
+        if ctx.message.attachments:
+            return None
+        if isinstance(link, PartialEmoji):
+            return str(link.url)
+        if isinstance(link, (Member, User)):
+            return str(self.avatar_asset(link))
+        return None
 
     @commands.group(invoke_without_command=True)
     async def distort(self, ctx: commands.Context, link: Optional[Union[PartialEmoji,Member,str]]):
@@ -29,78 +62,19 @@ class Distort(commands.Cog):
         image link
         IMPORTANT: image link needs to end in a filename (gif,png,jpg)
         """
-        message = ctx.message
-        if message.attachments:
-            url = str(message.attachments[0].url)
-            filetype = url[url.rfind('.')+1:]
-            pos = url.rfind("/")
-            filename = url[pos+1:]
-            if filetype.lower() not in self.allowed_file_extensions:
-                await ctx.send("not allowed filetype only images or gifs allowed")
-                return
-            await message.attachments[0].save(f"data/{filename}")
-        else:
-            if link is None:
-                return await ctx.send(
-                    "Please provide either a direct link to an image, "
-                    "a custom emote or a user mention/user id or upload a picture"
-                )
-            elif isinstance(link, PartialEmoji):
-                filetype = str(link.url)[str(link.url).rfind("."):]
-                filename = f"{link.name}{filetype}"
-                await link.url.save(f"data/{filename}")
-            elif isinstance(link, Member):
-                ctx.author = link
-                await ctx.invoke(self._me)
-                return
-            else:
-                try:
-                    async with self.session.get(url=link) as r:
-                        filetype = r.headers["Content-Type"].split("/")[1]
-                        filename = f"{uuid.uuid4()}.{filetype}"
-                        if filetype.lower() not in self.allowed_file_extensions:
-                            await ctx.send("not allowed filetype only images or gifs allowed")
-                            return
-                        if r.status == 200:
-                            with open(f"data/{filename}", "wb") as f:
-                                buffer = io.BytesIO(await r.read())
-                                f.write(buffer.read())
-                except aiohttp.InvalidURL:
-                    await ctx.send(
-                        "this command only works with custom emojis, direct image links or usernames or mentions."
-                    )
-                    return
-        async with ctx.typing():
-            output_file = await self.spawn_magick(filename, f".{filetype}")
-            await self.send_if_possible_and_delete(ctx, output_file)
+        if not ctx.message.attachments and link is None:
+            return await ctx.send(
+                "Please provide either a direct link to an image, "
+                "a custom emote or a user mention/user id or upload a picture"
+            )
+        await self.apply(ctx, link, 'distort')
 
     @distort.command(name="me")
     async def _me(self, ctx):
         """
         distort your user profile pic
         """
-        if ctx.author.is_avatar_animated():
-            asset = ctx.author.avatar_url_as(format="gif")
-            filetype = ".gif"
-        else:
-            asset = ctx.author.avatar_url_as(format="png")
-            filetype = ".png"
-        async with ctx.typing():
-            filename = f"{ctx.author.id}{filetype}"
-            await asset.save(f"data/{filename}")
-            output_path = await self.spawn_magick(filename=filename, filetype=filetype)
-            await self.send_if_possible_and_delete(ctx, output_path)
-
-    async def spawn_magick(self, filename, filetype):
-        output_path_temp = os.path.join('data', filename)
-        output_path_distort = os.path.join('data', str(uuid.uuid4()) + filetype)
-        proc = await asyncio.create_subprocess_exec(
-            self.image_magick_command, output_path_temp, '-layers', 'coalesce', '-liquid-rescale', '50%x50%',
-            '-resize', '200%', output_path_distort
-        )
-        await proc.communicate()
-        os.remove(output_path_temp)
-        return output_path_distort
+        await self.apply(ctx, ctx.author, 'distort')
 
     @commands.command()
     async def blur(self, ctx: commands.Context, intensity: Optional[int], link: Optional[Union[PartialEmoji, Member, str]]):
@@ -114,70 +88,61 @@ class Distort(commands.Cog):
             intensity = 1
         elif intensity > 15:
             intensity = 15
-        if ctx.message.attachments:
-            url = str(ctx.message.attachments[0].url)
-            filetype = url[url.rfind('.') + 1:]
-            pos = url.rfind("/")
-            filename = url[pos + 1:]
-            if filetype.lower() not in self.allowed_file_extensions:
-                await ctx.send("not allowed filetype only images or gifs allowed")
+        if not ctx.message.attachments and (link is None or (isinstance(link, str) and link.lower() == "me")):
+            link = ctx.author
+        await self.apply(ctx, link, 'blur', intensity)
+
+    async def apply(self, ctx, link, operation, *params):
+        """renders operation on the image link refers to, repeats are answered from the result cache"""
+        asset_url = self.asset_url(ctx, link)
+        if asset_url:
+            key = self.cache.key(asset_url.encode(), operation, *params)
+            if await self.send_cached(ctx, key):
                 return
-            await ctx.message.attachments[0].save(f"data/{filename}")
-        elif link is None or link.lower() == "me":
-            asset = ctx.author.avatar_url_as(format="png")
-            filetype = ".png"
-            filename = str(ctx.author.id) + filetype
-            await asset.save(f"data/{ctx.author.id}{filetype}")
-        elif isinstance(link, PartialEmoji):
-            filetype = str(link.url)[str(link.url).rfind("."):]
-            filename = f"{link.name}{filetype}"
-            await link.url.save(f"data/{filename}")
-        elif isinstance(link, Member):
-            asset = link.avatar_url_as(format="png")
-            filetype = ".png"
-            filename = str(ctx.author.id) + filetype
-            await asset.save(f"data/{ctx.author.id}{filetype}")
-        else:
-            try:
-                async with self.session.get(url=link) as r:
-                    filetype = r.headers["Content-Type"].split("/")[1]
-                    filename = f"{uuid.uuid4()}.{filetype}"
-                    if filetype.lower() not in self.allowed_file_extensions:
-                        await ctx.send("not allowed filetype only images or gifs allowed")
-                        return
-                    if r.status == 200:
-                        with open(f"data/{filename}", "wb") as f:
-                            buffer = io.BytesIO(await r.read())
-                            f.write(buffer.read())
-            except aiohttp.InvalidURL:
-                await ctx.send(
-                    "this command only works with custom emojis, direct image links or usernames or mentions.")
+        data = await self.read_image(ctx, link)
+        if data is None:
+            return
+        if not asset_url:
+            key = self.cache.key(data, operation, *params)
+            if await self.send_cached(ctx, key):
                 return
         async with ctx.typing():
-            output_path = await self.create_rad_blur(filename, filetype, intensity)
-            await self.send_if_possible_and_delete(ctx, output_path)
+            try:
+                if operation == 'blur':
+                    output, filetype = await self.pipeline.blur(data, *params)
+                else:
+                    output, filetype = await self.pipeline.distort(data)
+            except (OSError, RuntimeError):
+                return await ctx.send(f"Couldn't {operation} that image.")
+            await self.cache.put(key, output, filetype)
+            message = await self.send_if_possible(ctx, output, filetype)
+        if message and message.attachments:
+            self.cache.set_url(key, message.attachments[0].url)
 
-    async def create_rad_blur(self, filename, filetype, intensity):
-        if not filetype.startswith("."):
-            filetype = "." + filetype
-        output_path_temp = os.path.join('data', filename)
-        output_path_blur = os.path.join('data', str(uuid.uuid4()) + filetype)
-        proc = await asyncio.create_subprocess_exec(
-            self.image_magick_command, output_path_temp, '-rotational-blur', str(intensity), output_path_blur
-        )
-        await proc.communicate()
-        os.remove(output_path_temp)
-        return output_path_blur
+    async def send_cached(self, ctx, key):
+        url = self.cache.get_url(key)
+        if url:
+            await ctx.send(url)
+            return True
+        cached = await self.cache.get(key)
+        if cached is None:
+            return False
+        message = await self.send_if_possible(ctx, *cached)
+        if message and message.attachments:
+            self.cache.set_url(key, message.attachments[0].url)
+        return True
 
-    async def send_if_possible_and_delete(self, ctx, file_path):
+    async def send_if_possible(self, ctx, data, filetype):
         size = 8388608
         if ctx.guild:
             size = ctx.guild.filesize_limit
-        if os.path.getsize(file_path) < size:
-            await ctx.send(file=File(file_path))
-        else:
-            await ctx.send("Send failed. The generated file exceeds this discord servers filesize limit.")
-        os.remove(file_path)
+        if len(data) >= size:
+            shrunk = await self.pipeline.shrink_to_fit(data, size)
+            if shrunk is None:
+                await ctx.send("Send failed. The generated file exceeds this discord servers filesize limit.")
+                return None
+            data, filetype = shrunk
+        return await ctx.send(file=File(io.BytesIO(data), filename=f"{ctx.command.name}.{filetype}"))
 
 
 def setup(bot: commands.Bot):
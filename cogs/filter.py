@@ -1,22 +1,47 @@
 from discord.ext import commands
+from functools import partial
+import aiohttp
 import discord
+import datetime
 import json
 import asyncio
 import re
 import os
-from aiohttp import ClientSession
+from .utils.cache import AsyncTTLCache
 from .utils.checks import is_owner_or_moderator
+from .utils.http import get_session
+from .utils.message_scanner import get_scanner
+
+# how long a gallery verdict is kept in nhentai_galleries, galleries that didn't exist are checked sooner
+BANNED_VERDICT_TTL = datetime.timedelta(days=30)
+CLEAN_VERDICT_TTL = datetime.timedelta(days=7)
+MISSING_VERDICT_TTL = datetime.timedelta(days=1)
+# in memory verdicts in front of the table
+VERDICT_CACHE_SIZE = 2048
+VERDICT_CACHE_SECONDS = 3600
+NHENTAI_CONCURRENCY = 4
+# numbers of a message checked as gallery ids when a moderator reacts with the microscope,
+# explicit gallery links are always checked
+MAX_GALLERIES_PER_MESSAGE = 5
 
 class Filter(commands.Cog):
     """
     filters messages and removes them
     """
+    gif_link_regex = re.compile(r"^https://(media\.)?(tenor|giphy)?.com/")
+    nhentai_link_regex = re.compile(r"https?://nhentai\.net/g/(\d+)/")
 
     def __init__(self, bot):
         self.bot = bot
         self.filter_file_path = "data/filter.json"
-        self.session = ClientSession()
+        self.session = get_session(bot)
         self.banned_tags = ['lolicon', 'shotacon']
+        # gallery id -> first banned tag, '' for clean or missing galleries
+        self.gallery_verdicts = AsyncTTLCache(maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_SECONDS)
+        self.nhentai_semaphore = asyncio.Semaphore(NHENTAI_CONCURRENCY)
+        # set once nhentai_galleries exists, lookups wait for it
+        self.gallery_cache_ready = asyncio.Event()
+        self.bot.loop.create_task(self.init_gallery_cache())
 
         if os.path.exists(self.filter_file_path):
             with open(self.filter_file_path, "r") as filter_file:
@@ -28,50 +53,99 @@ class Filter(commands.Cog):
         else:
             open(self.filter_file_path, 'w').close()
             self.allowed_channel = None
+        self.scanner = get_scanner(bot)
+        self.scanner.register("filter_gif", self.on_gif_link, pattern=self.gif_link_regex,
+                              check=lambda message: message.channel != self.allowed_channel)
+        self.scanner.register("filter_nhentai", self.on_nhentai_link, pattern=self.nhentai_link_regex)
 
     def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
-
-    @commands.Cog.listener("on_message")
-    async def on_message(self, message):
-        contains_giphy_or_tenor_link_regex = re.compile("https://(media\.)?(tenor|giphy)?.com/")
-        match = contains_giphy_or_tenor_link_regex.match(message.content)
-        if match and not message.channel == self.allowed_channel:
-            await asyncio.sleep(1)
+        self.scanner.unregister("filter_gif")
+        self.scanner.unregister("filter_nhentai")
+
+    async def on_gif_link(self, message, match):
+        await asyncio.sleep(1)
+        await message.delete()
+
+    async def on_nhentai_link(self, message, match):
+        gallery_ids = [int(gallery_id) for gallery_id in self.nhentai_link_regex.findall(message.content)]
+        tag = await self.find_banned_tag(gallery_ids)
+        if tag:
             await message.delete()
-        contains_nhentai_link = re.compile(r"https?://nhentai\.net/g/(\d+)/")
-        matches = contains_nhentai_link.findall(message.content)
-        if matches:
-            for match in matches:
-                _id = int(match)
-                data = await self.call_nhentai_api(_id)
-                for tag in data['tags']:
-                    if tag['name'] in self.banned_tags:
-                        await message.delete()
-                        await message.channel.send(f"{message.author.mention} your link was deleted because it contained"
-                                                   f" a forbidden tag: {tag['name']} (Server Rule 5)")
-                        admin_cog = self.bot.get_cog("Admin")
-                        if admin_cog and admin_cog.check_channel:
-                            await admin_cog.check_channel.send(f"deleted nhentai link by {message.author.mention} "
-                                                                f"because it contained a banned tag: {tag['name']}")
+            await message.channel.send(f"{message.author.mention} your link was deleted because it contained"
+                                       f" a forbidden tag: {tag} (Server Rule 5)")
+            admin_cog = self.bot.get_cog("Admin")
+            if admin_cog and admin_cog.check_channel:
+                await admin_cog.check_channel.send(f"deleted nhentai link by {message.author.mention} "
+                                                    f"because it contained a banned tag: {tag}")
 
     async def check_for_tags(self, message):
-        matches = re.findall(r'\b\d{1,6}\b', message)
-        if matches:
-            for match in matches:
-                number = int(match)
-                data = await self.call_nhentai_api(number)
-                if data:
-                    for tag in data['tags']:
-                        if tag['name'] in self.banned_tags:
-                            return True, tag['name']
-        return False, None
+        # bare numbers are only guesses, a message full of them mustn't flood nhentai
+        gallery_ids = list(dict.fromkeys(int(match) for match in re.findall(r'\b\d{1,6}\b', message)))
+        gallery_ids = gallery_ids[:MAX_GALLERIES_PER_MESSAGE]
+        tag = await self.find_banned_tag(gallery_ids)
+        return tag is not None, tag
+
+    async def init_gallery_cache(self):
+        query = '''
+            CREATE TABLE IF NOT EXISTS nhentai_galleries(
+                gallery_id BIGINT PRIMARY KEY,
+                banned_tag TEXT,
+                expires timestamp NOT NULL
+            )
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query)
+                await con.execute("DELETE FROM nhentai_galleries WHERE expires < $1", datetime.datetime.utcnow())
+        self.gallery_cache_ready.set()
+
+    async def find_banned_tag(self, gallery_ids):
+        """
+        first banned tag of the galleries, None if all of them are clean.
+        every id is looked up once, verdicts come from the cache before the api is asked
+        """
+        gallery_ids = list(dict.fromkeys(gallery_ids))
+        verdicts = await asyncio.gather(*[
+            self.gallery_verdicts.get_or_fetch(gallery_id, partial(self.fetch_gallery_verdict, gallery_id))
+            for gallery_id in gallery_ids
+        ])
+        return next((verdict for verdict in verdicts if verdict), None)
+
+    async def fetch_gallery_verdict(self, gallery_id: int):
+        """:return: first banned tag of the gallery, '' if it is clean or doesn't exist, None if nhentai failed"""
+        await self.gallery_cache_ready.wait()
+        now = datetime.datetime.utcnow()
+        async with self.bot.db.acquire() as con:
+            row = await con.fetchrow("SELECT banned_tag FROM nhentai_galleries WHERE gallery_id = $1 AND expires > $2",
+                                     gallery_id, now)
+        if row:
+            return row["banned_tag"] or ''
+        async with self.nhentai_semaphore:
+            try:
+                status, data = await self.call_nhentai_api(gallery_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+        if status == 404:
+            banned_tag, ttl = None, MISSING_VERDICT_TTL
+        elif data:
+            banned_tag = next((tag['name'] for tag in data['tags'] if tag['name'] in self.banned_tags), None)
+            ttl = BANNED_VERDICT_TTL if banned_tag else CLEAN_VERDICT_TTL
+        else:
+            return None
+        query = ("INSERT INTO nhentai_galleries VALUES ($1, $2, $3) "
+                 "ON CONFLICT (gallery_id) DO UPDATE SET banned_tag = $2, expires = $3")
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query, gallery_id, banned_tag, now + ttl)
+        return banned_tag or ''
 
     async def call_nhentai_api(self, id: int):
+        """:return: status and the gallery json, None if the status isn't 200"""
         url = f"https://nhentai.net/api/gallery/{id}"
         async with self.session.get(url) as response:
             if response.status == 200:
-                return await response.json()
+                return response.status, await response.json()
+            return response.status, None
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction, user):
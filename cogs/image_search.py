@@ -3,64 +3,71 @@ from email.mime import base
 from discord.ext import commands
 import discord
 import aiohttp
-from bs4 import BeautifulSoup
-import json
 from urllib import parse
 import youtube_dl
 import base64
 import os
 import urllib.parse
-import sys
-from PIL import Image
 import PIL
 import mimetypes
 import io
 import asyncio
 import typing
+import time
+import logging
+import datetime
+from .utils.danbooru_client import get_client
+from .utils.http import get_session
+from .utils.imaging import downscale_for_search
+from .utils.media import fetch_media, FrameExtractor, MediaError, MAX_MEDIA_BYTES
+from .utils.phash import BKTree, dhash, to_signed, to_unsigned
+from .utils.scraping import run_parser, parse_iqdb, parse_saucenao, parse_tineye
+
+# seconds each engine of the combined search gets before it is reported as timed out
+SEARCH_ENGINE_TIMEOUT = 20
+MAX_SEARCH_RESULTS = 8
+# images whose hashes differ in at most this many of the 64 bits are treated as the same image
+SOURCE_MATCH_DISTANCE = 5
+# search results that are good enough to be remembered as the source, whatever threshold the user asked for
+SOURCE_MIN_SIMILARITY = 0.9
+# only these engines find the source of an image, trace.moe finds scenes and tineye other copies
+SOURCE_ENGINES = ('iqdb', 'saucenao')
+# remembered sources, older ones are dropped first
+SOURCE_CACHE_SIZE = 10000
+SOURCE_CACHE_MAX_AGE = datetime.timedelta(days=180)
+# hashing before a search only downloads images up to this size, bigger ones are just searched
+SOURCE_HASH_MAX_BYTES = 2 * 1024 * 1024
+# keeps the newest SOURCE_CACHE_SIZE sources
+TRIM_SOURCES_QUERY = '''
+    DELETE FROM image_sources WHERE id NOT IN (
+        SELECT id FROM image_sources ORDER BY id DESC LIMIT $1
+    )
+'''
+
+
+class SearchResult:
+    def __init__(self, engine, url, title, similarity=None):
+        self.engine = engine
+        self.url = url
+        self.title = title
+        # between 0 and 1, None for engines that don't rate their matches
+        self.similarity = similarity
 
 
 class TraceMoe:
 
     @staticmethod
-    async def get_frame(url, session):
+    async def get_frame(url, session, frame_extractor):
         mime_type = mimetypes.guess_type(url)
-        if any(mime_type) and mime_type:
-            if "image" in mime_type[0]:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        return io.BytesIO(await response.read())
-                    return None
-            elif "video" in mime_type[0]:
-                process = await asyncio.create_subprocess_exec(
-                    'ffmpeg', '-y', '-i', url,
-                    '-vframes', '1',
-                    '-hide_banner','-loglevel', 'panic', 'data/trace/frame.jpg'
-                )
-                await process.communicate()
-                with open('data/trace/frame.jpg', 'rb') as f:
-                    return io.BytesIO(f.read())
+        try:
+            if any(mime_type) and mime_type and "video" in mime_type[0]:
+                return io.BytesIO(await frame_extractor.extract(url))
+            # the type of links without a known extension is taken from the file itself
+            media = await fetch_media(session, url)
+        except MediaError:
             return None
+        return io.BytesIO(media.data)
 
-    @staticmethod
-    def scale_image_down(image):
-        img = io.BytesIO()
-        image.save(img, format(image.format))
-        im_size = sys.getsizeof(img.getvalue())
-        max_size = 1* 10 ** 6
-        if image.format == 'GIF' and image.is_animated:
-            image_save = io.BytesIO()
-            image.save(image_save, format("PNG"), save_all=False)
-            return base64.b64encode(image_save.getvalue()).decode('ascii')
-        elif im_size > max_size:
-            divisor = im_size / max_size
-            new_width = int(image.size[0] // divisor)
-            wpercent = (new_width / float(image.size[0]))
-            new_height = int(float(image.size[1]) * float(wpercent))
-            img = image.resize((new_width, new_height), Image.ANTIALIAS)
-            img_save = io.BytesIO()
-            img.save(img_save, format('PNG'))
-            return base64.b64encode(img_save.getvalue()).decode('ascii')
-        return base64.b64encode(img.getvalue()).decode('ascii')
 
 
 class Search(commands.Cog):
@@ -68,10 +75,14 @@ class Search(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.iqdb_session = aiohttp.ClientSession()
-        self.dans_session = aiohttp.ClientSession()
-        self.sauce_session = aiohttp.ClientSession()
-        self.tineye_session = aiohttp.ClientSession()
+        self.session = get_session(bot)
+        self.danbooru_client = get_client(bot)
+        self.frame_extractor = FrameExtractor()
+        self.source_index = BKTree()
+        # (hash, record) oldest first, the index is rebuilt from it when it's trimmed
+        self.sources = []
+        self.logger = logging.getLogger('PoutyBot')
+        self.bot.loop.create_task(self.init_source_cache())
         if not os.path.exists("data/image_search"):
             os.mkdir("data/image_search/")
 
@@ -81,21 +92,8 @@ class Search(commands.Cog):
         :param link: must be a valid danbooru link
         :return: characters, artist, copyright (franchise)
         """
-
-        # json file with api key and user name for danbooru
-        # Structure:
-        # {
-        #  "user": "username",
-        #  "api_key": "ValidApiKey123"
-        # }
-        auth_file_path = 'data/danbooru/danbooru.json'
-        with open(auth_file_path, 'r') as file:
-            data = json.load(file)
-            user = data['user']
-            api_key = data['api_key']
-        auth = aiohttp.BasicAuth(user, api_key)
         characters, artist, franchise, source = None, None, None, None
-        async with self.dans_session.get('{}.json'.format(link), auth=auth) as response:
+        async with self.danbooru_client.get('{}.json'.format(link)) as response:
             if response.status == 200:
                 json_dump = await response.json()
                 if json_dump['tag_count_character'] > 0:
@@ -113,13 +111,6 @@ class Search(commands.Cog):
             else:
                 await ctx.send("\n HTTP Error occured with following Status Code:{}".format(response.status))
 
-    def cog_unload(self):
-        loop = self.bot.loop or asyncio.get_event_loop()
-        loop.create_task(self.iqdb_session.close())
-        loop.create_task(self.dans_session.close())
-        loop.create_task(self.sauce_session.close())
-        loop.create_task(self.tineye_session.close())
-
 
     def _tag_to_title(self, tag):
         return tag.replace(' ', '\n').replace('_', ' ').title()
@@ -139,47 +130,142 @@ class Search(commands.Cog):
             if link:
                 url = link
             else:
-                url = file[0]['proxy_url']
-            async with self.iqdb_session.post(url='https://iqdb.org', data={'url': url}) as response:
+                url = file[0].proxy_url
+            image_hash = await self.cached_image_hash(url)
+            cached = self.lookup_source(image_hash)
+            if cached:
+                await self.send_source(ctx, cached, url)
+                return
+            async with self.session.post(url='https://iqdb.org', data={'url': url}) as response:
                 if response.status == 200:
-                    soup = BeautifulSoup(await response.text(), 'html.parser')
-                    # This is for the no relevant matches case
-                    pages_div = soup.find(id='pages').find_all('div')[1]
+                    matches = await run_parser(parse_iqdb, await response.text())
                     # stop searching if no relevant match was found
-                    if str(pages_div.find('th')) == '<th>No relevant matches</th>':
+                    if not matches or not matches[0]['relevant']:
                         await ctx.send('No relevant Match was found')
                         return
 
-                    matches = soup.find(id='pages')
-                    best_match = matches.select('a')[0].attrs['href']
-                    danbooru_found = False
-                    for match in matches.select('a'):
-                        source = match.attrs['href']
-                        if source.startswith('//danbooru.donmai.us') and not danbooru_found:
-                            danbooru_found = True
+                    best_match = matches[0]['url']
+                    record = {'source': best_match, 'engine': 'iqdb'}
+                    similarity = matches[0]['similarity']
+                    for match in matches:
+                        source = match['url']
+                        if source.startswith('//danbooru.donmai.us'):
                             danbooru = 'http:'+source
                             characters, artist, franchise, source_url = await self._danbooru_api(ctx, danbooru)
-                            embed = discord.Embed(colour=discord.Colour(0xa4815f), description="Source found via [iqdb](https://iqdb.org/)")
+                            record = {'source': source_url, 'danbooru': danbooru, 'characters': characters,
+                                      'artist': artist, 'copyright': franchise, 'engine': 'iqdb'}
+                            similarity = match['similarity']
+                            break
+                    await self.send_source(ctx, record, url)
+                    await self.remember_source(image_hash, record, similarity, url)
+
+    def build_source_embed(self, record, url):
+        embed = discord.Embed(colour=discord.Colour(0xa4815f),
+                              description="Source found via [iqdb](https://iqdb.org/)")
+        embed.set_thumbnail(url=url)
+        characters, artist, source_url = record.get('characters'), record.get('artist'), record.get('source')
+        if characters:
+            embed.add_field(name="Character", value=characters)
+        if artist or source_url:
+            if source_url and artist:
+                embed.add_field(name="Artist", value="[{}]({})".format(artist, source_url))
+            elif artist:
+                embed.add_field(name="Artist", value=artist)
+            else:
+                embed.add_field(name="Source", value=source_url)
+        if record.get('copyright'):
+            embed.add_field(name="Copyright", value=record['copyright'])
+        embed.add_field(name="Danbooru", value=record['danbooru'])
+        return embed
 
-                            embed.set_thumbnail(url=url)
+    async def send_source(self, ctx, record, url):
+        if record.get('danbooru'):
+            await ctx.send(embed=self.build_source_embed(record, url))
+        else:
+            await ctx.send('<{}>'.format(record['source']))
+
+    async def init_source_cache(self):
+        query = '''
+            CREATE TABLE IF NOT EXISTS image_sources(
+                id SERIAL PRIMARY KEY,
+                hash BIGINT NOT NULL,
+                source TEXT,
+                danbooru TEXT,
+                characters TEXT,
+                artist TEXT,
+                copyright TEXT,
+                engine TEXT NOT NULL,
+                created timestamp NOT NULL DEFAULT NOW()
+            )
+        '''
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(query)
+                await con.execute("DELETE FROM image_sources WHERE created < $1",
+                                  datetime.datetime.utcnow() - SOURCE_CACHE_MAX_AGE)
+                await con.execute(TRIM_SOURCES_QUERY, SOURCE_CACHE_SIZE)
+            rows = await con.fetch("SELECT * FROM image_sources ORDER BY id")
+        for row in rows:
+            record = dict(row)
+            self.sources.append((to_unsigned(record.pop('hash')), record))
+        self._rebuild_source_index()
 
-                            if characters:
-                                embed.add_field(name="Character", value=characters)
-                            if artist or source_url:
-                                if source_url and artist:
-                                    embed.add_field(name="Artist", value="[{}]({})".format(artist, source_url))
-                                elif artist:
-                                    embed.add_field(name="Artist", value=artist)
-                                else:
-                                    embed.add_field(name="Source", value=source_url)
+    def _rebuild_source_index(self):
+        self.sources = self.sources[-SOURCE_CACHE_SIZE:]
+        self.source_index = BKTree()
+        for image_hash, record in self.sources:
+            self.source_index.add(image_hash, record)
 
-                            if franchise:
-                                embed.add_field(name="Copyright", value=franchise)
-                            embed.add_field(name="Danbooru", value=danbooru)
+    async def image_hash(self, url, max_bytes=MAX_MEDIA_BYTES):
+        """perceptual hash of the image behind url, None if it isn't an image that can be read"""
+        try:
+            media = await fetch_media(self.session, url, max_bytes=max_bytes)
+            return await self.bot.loop.run_in_executor(None, dhash, bytes(media.data))
+        except (MediaError, OSError):
+            return None
 
-                            await ctx.send(embed=embed)
-                    if not danbooru_found:
-                        await ctx.send('<{}>'.format(best_match))
+    async def cached_image_hash(self, url):
+        """
+        hash of the image for the lookup before a search,
+        only downloaded while there are sources to compare with and only if the image is small
+        """
+        if not len(self.source_index):
+            return None
+        return await self.image_hash(url, SOURCE_HASH_MAX_BYTES)
+
+    def lookup_source(self, image_hash):
+        """:return: the remembered source of the closest known image, None if there is none close enough"""
+        if image_hash is None:
+            return None
+        matches = self.source_index.search(image_hash, SOURCE_MATCH_DISTANCE)
+        return matches[0][1] if matches else None
+
+    async def remember_source(self, image_hash, record, similarity, url=None):
+        """
+        remembers the source of an image if the engine was sure enough about it,
+        whatever threshold the user searched with. without a hash the image behind url is hashed
+        """
+        if similarity is None or similarity < SOURCE_MIN_SIMILARITY:
+            return
+        if not record.get('source') and not record.get('danbooru'):
+            return
+        if image_hash is None and url:
+            image_hash = await self.image_hash(url)
+        if image_hash is None:
+            return
+        self.sources.append((image_hash, record))
+        self.source_index.add(image_hash, record)
+        # trimmed in steps, the index can only be shrunk by rebuilding it
+        if len(self.sources) > SOURCE_CACHE_SIZE * 1.1:
+            self._rebuild_source_index()
+        async with self.bot.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(
+                    "INSERT INTO image_sources(hash, source, danbooru, characters, artist, copyright, engine) "
+                    "VALUES($1, $2, $3, $4, $5, $6, $7)",
+                    to_signed(image_hash), record.get('source'), record.get('danbooru'), record.get('characters'),
+                    record.get('artist'), record.get('copyright'), record['engine'])
+                await con.execute(TRIM_SOURCES_QUERY, SOURCE_CACHE_SIZE)
 
     @commands.command(pass_context=True)
     async def sauce(self, ctx, link=None, similarity=80):
@@ -198,17 +284,23 @@ class Search(commands.Cog):
                 similarity = link if link is not None else similarity
             else:
                 url = link
-            async with self.sauce_session.get('http://saucenao.com/search.php?url={}'.format(url)) as response:
+            image_hash = await self.cached_image_hash(url)
+            cached = self.lookup_source(image_hash)
+            if cached:
+                await self.send_source(ctx, cached, url)
+                return
+            async with self.session.get('http://saucenao.com/search.php?url={}'.format(url)) as response:
                 source = None
                 if response.status == 200:
-                    soup = BeautifulSoup(await response.text(), 'html.parser')
-                    for result in soup.select('.resulttablecontent'):
-                        if float(similarity) > float(result.select('.resultsimilarityinfo')[0].contents[0][:-1]):
+                    for result in await run_parser(parse_saucenao, await response.text()):
+                        if float(similarity) > result['similarity']:
                             break
                         else:
-                            if result.select('a'):
-                                source = result.select('a')[0]['href']
+                            if result['url']:
+                                source = result['url']
                                 await ctx.send('<{}>'.format(source))
+                                await self.remember_source(image_hash, {'source': source, 'engine': 'saucenao'},
+                                                           result['similarity'] / 100, url)
                                 return
                     if source is None:
                         await ctx.send('No source over the similarity threshold')
@@ -229,15 +321,13 @@ class Search(commands.Cog):
                 url = file[0].url
             else:
                 url = link
-            async with self.tineye_session.get('https://tineye.com/search/?url={}'.format(url)) as response:
-                soup = BeautifulSoup(await response.text(), 'html.parser')
-                pages = []
-                image_link = None
-                for hidden in soup.find(class_='match').select('.hidden-xs'):
-                    if hidden.contents[0].startswith('Page:'):
-                        pages.append('<{}>'.format(hidden.next_sibling['href']))
-                    else:
-                        image_link = hidden.a['href']
+            async with self.session.get('https://tineye.com/search/?url={}'.format(url)) as response:
+                matches = await run_parser(parse_tineye, await response.text())
+                if not matches:
+                    await ctx.send('No match was found')
+                    return
+                pages = ['<{}>'.format(page) for page in matches[0]['pages']]
+                image_link = matches[0]['image']
             message = '\n**Pages:** '
             message += '\n**Pages:** '.join(pages)
             if image_link is not None:
@@ -278,12 +368,15 @@ class Search(commands.Cog):
             await ctx.send("please add an image link or invoke with an image attached")
             return
         image_link = link if link is not None else ctx.message.attachments[0].url
-        image = await TraceMoe.get_frame(image_link, self.sauce_session)
+        image = await TraceMoe.get_frame(image_link, self.session, self.frame_extractor)
         if image:
-            im = Image.open(image)
+            try:
+                scaled = await downscale_for_search(image.getvalue())
+            except OSError:
+                return await ctx.send("Could not read that image.")
             header = {"Content-Type": "application/json"}
-            request_data = {"image": TraceMoe.scale_image_down(im)}
-            async with self.sauce_session.post(json=request_data, headers=header, url="https://trace.moe/api/search") as resp:
+            request_data = {"image": base64.b64encode(scaled).decode('ascii')}
+            async with self.session.post(json=request_data, headers=header, url="https://trace.moe/api/search") as resp:
                 if resp.status == 200:
                     resp_json = await resp.json()
                     sorted_found = sorted(resp_json["docs"], key=lambda d: d['similarity'], reverse=True)
@@ -306,6 +399,142 @@ class Search(commands.Cog):
                            "\n(for imgur please use the .gif instead of gifv)")
 
 
+    @commands.command(name="search", aliases=["source"])
+    @commands.cooldown(rate=1, per=30, type=commands.BucketType.user)
+    async def combined_search(self, ctx, link: typing.Optional[str] = None):
+        """
+        searches iqdb, saucenao, trace.moe and tineye at the same time
+        the results are merged and ranked by similarity while the engines answer
+        usage:  .search <link> or
+                .search on image upload comment
+        """
+        if link is None and not ctx.message.attachments:
+            await ctx.send('Message didn\'t contain Image')
+            return
+        url = link if link is not None else ctx.message.attachments[0].url
+        await ctx.trigger_typing()
+        frame = await TraceMoe.get_frame(url, self.session, self.frame_extractor)
+        if frame is None:
+            await ctx.send("Could not detect filetype, be sure to use actual media files")
+            return
+        try:
+            image = await downscale_for_search(frame.getvalue())
+        except OSError:
+            await ctx.send("Could not read that image.")
+            return
+        image_hash = await self.bot.loop.run_in_executor(None, dhash, image)
+        cached = self.lookup_source(image_hash)
+        if cached:
+            await self.send_source(ctx, cached, url)
+            return
+        engines = {
+            'iqdb': self._search_iqdb(image),
+            'saucenao': self._search_saucenao(image),
+            'trace.moe': self._search_trace_moe(image),
+            'tineye': self._search_tineye(url),
+        }
+        status = {engine: 'searching' for engine in engines}
+        results = []
+        start = time.monotonic()
+        message = await ctx.send(embed=self.build_search_embed(url, results, status))
+
+        async def run(engine, search):
+            try:
+                return engine, await asyncio.wait_for(search, SEARCH_ENGINE_TIMEOUT), None
+            except asyncio.TimeoutError:
+                return engine, [], 'timed out'
+            except Exception as e:
+                # one broken engine must not take the others down with it
+                self.logger.warning(f"{engine} search for {url} failed: {type(e).__name__}: {e}")
+                return engine, [], 'failed'
+
+        tasks = [self.bot.loop.create_task(run(engine, search)) for engine, search in engines.items()]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                engine, found, error = await finished
+                results += found
+                status[engine] = error or f"{len(found)} in {time.monotonic() - start:.1f}s"
+                await message.edit(embed=self.build_search_embed(url, results, status))
+        finally:
+            # the embed edit can fail, the engines still running are not left behind
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # scene links of trace.moe and copies found by tineye aren't the source of the image
+        rated = [result for result in results
+                 if result.similarity is not None and result.engine in SOURCE_ENGINES]
+        best = max(rated, key=lambda result: result.similarity, default=None)
+        if best:
+            await self.remember_source(image_hash, {'source': best.url, 'engine': best.engine}, best.similarity)
+
+    def build_search_embed(self, url, results, status):
+        # rated matches first, best first, unrated ones keep the order they arrived in
+        ranked = sorted(results, key=lambda result: -(result.similarity or 0))
+        embed = discord.Embed(colour=discord.Colour(0xa4815f), title="Reverse image search")
+        if url.startswith('http'):
+            embed.set_thumbnail(url=url)
+        for result in ranked[:MAX_SEARCH_RESULTS]:
+            similarity = f"{result.similarity:.0%}" if result.similarity is not None else "?"
+            embed.add_field(name=f"{similarity} · {result.engine}",
+                            value=f"[{result.title[:200]}]({result.url})", inline=False)
+        if not ranked and 'searching' not in status.values():
+            embed.description = "No matches found"
+        embed.set_footer(text=" | ".join(f"{engine}: {state}" for engine, state in status.items()))
+        return embed
+
+    async def _search_iqdb(self, image):
+        data = aiohttp.FormData()
+        data.add_field('file', image, filename='image.jpg', content_type='image/jpeg')
+        async with self.session.post('https://iqdb.org/', data=data) as response:
+            response.raise_for_status()
+            matches = await run_parser(parse_iqdb, await response.text())
+        results = []
+        for match in matches:
+            if not match['relevant'] or match['similarity'] is None:
+                continue
+            href = match['url']
+            if href.startswith('//'):
+                href = 'https:' + href
+            results.append(SearchResult('iqdb', href, parse.urlparse(href).netloc, match['similarity']))
+        return results
+
+    async def _search_saucenao(self, image):
+        data = aiohttp.FormData()
+        data.add_field('file', image, filename='image.jpg', content_type='image/jpeg')
+        async with self.session.post('https://saucenao.com/search.php', data=data) as response:
+            response.raise_for_status()
+            found = await run_parser(parse_saucenao, await response.text())
+        results = []
+        for result in found:
+            link = result['content_url'] or result['url']
+            if not link:
+                continue
+            title = result['title'] or parse.urlparse(link).netloc
+            results.append(SearchResult('saucenao', link, title, result['similarity'] / 100))
+        return results
+
+    async def _search_trace_moe(self, image):
+        request_data = {"image": base64.b64encode(image).decode('ascii')}
+        async with self.session.post("https://trace.moe/api/search", json=request_data) as response:
+            response.raise_for_status()
+            resp_json = await response.json()
+        results = []
+        for doc in resp_json["docs"]:
+            m, s = divmod(doc["at"], 60)
+            title = "{} episode {} at {:02d}:{:02d}".format(doc["title_romaji"], doc["episode"], int(m), int(s))
+            results.append(SearchResult('trace.moe', self.build_anilist_link_from_id(doc["anilist_id"]),
+                                        title, doc["similarity"]))
+        return results
+
+    async def _search_tineye(self, url):
+        if not url.startswith('http'):
+            return []
+        async with self.session.get('https://tineye.com/search/?url={}'.format(url)) as response:
+            response.raise_for_status()
+            matches = await run_parser(parse_tineye, await response.text())
+        return [SearchResult('tineye', page, parse.urlparse(page).netloc)
+                for match in matches for page in match['pages']]
+
     def build_embed_for_trace_moe(self, first_result):
         embed = discord.Embed(colour=discord.Colour(0xa4815f),
                               description="Source found via [trace.moe](https://trace.moe/)")
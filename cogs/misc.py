@@ -688,10 +688,10 @@ import json
 import random
 import re
 import typing
+from .utils.http import get_session
 import asyncio
 from emojipedia import Emojipedia
 from functools import partial
-import aiohttp
 
 
 class Misc(commands.Cog):
@@ -962,7 +962,7 @@ class SCP(commands.Cog):
     """
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
+        self.session = get_session(bot)
 
     @commands.group(invoke_without_command=True)
     async def scp(self, ctx, number):
@@ -999,9 +999,6 @@ class SCP(commands.Cog):
 
 
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
-
 
 def setup(bot):
     global logger
@@ -1,11 +1,11 @@
 import discord
 from discord.ext import commands
-import aiohttp
+from .utils.http import get_session
 class MyAnimeList(commands.Cog):
     """Commands for searching myanimelist.net"""
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
+        self.session = get_session(bot)
         self.remaining_requests = None
 
     async def jikan_call(self, endpoint: str, parameters: dict):
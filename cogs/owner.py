@@ -83,6 +83,40 @@ class Owner(commands.Cog):
         await ctx.send('Shutting down...')
         await self.bot.logout()
 
+    @commands.command(name='http_stats', hidden=True)
+    @checks.is_owner()
+    async def http_stats(self, ctx):
+        """Shows requests, failures and latency per host of the shared http session"""
+        metrics = getattr(self.bot, 'http_metrics', None)
+        if not metrics or not metrics.hosts:
+            return await ctx.send("No requests yet")
+        paginator = commands.Paginator(prefix='```', suffix='```')
+        paginator.add_line(f"{'host':<32}{'requests':>9}{'failed':>8}{'p50':>8}{'p95':>8}")
+        for host, host_metrics in sorted(metrics.hosts.items(), key=lambda item: -item[1].requests):
+            p50, p95 = host_metrics.percentile(0.5), host_metrics.percentile(0.95)
+            paginator.add_line(f"{host[:31]:<32}{host_metrics.requests:>9}{host_metrics.failures:>8}"
+                               f"{p50 or 0:>7.2f}s{p95 or 0:>7.2f}s")
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(name='scanner_stats', hidden=True)
+    @checks.is_owner_or_moderator()
+    async def scanner_stats(self, ctx):
+        """Shows scan time per message and calls and time per rule of the message scanner"""
+        scanner = getattr(self.bot, 'message_scanner', None)
+        if not scanner or not scanner.messages:
+            return await ctx.send("No messages scanned yet")
+        paginator = commands.Paginator(prefix='```', suffix='```')
+        paginator.add_line(f"{scanner.messages} messages, "
+                           f"{scanner.scan_time / scanner.messages * 1e6:.1f}µs scan per message")
+        paginator.add_line(f"{'rule':<20}{'calls':>8}{'errors':>8}{'avg':>10}{'max':>10}")
+        for rule in sorted(scanner.rules.values(), key=lambda rule: -rule.total_time):
+            average = rule.total_time / rule.calls if rule.calls else 0
+            paginator.add_line(f"{rule.name[:19]:<20}{rule.calls:>8}{rule.errors:>8}"
+                               f"{average * 1000:>8.1f}ms{rule.max_time * 1000:>8.1f}ms")
+        for page in paginator.pages:
+            await ctx.send(page)
+
     @commands.group(pass_context=True, aliases=['bl'])
     @checks.is_owner_or_moderator()
     async def blacklist(self, ctx):
@@ -8,6 +8,7 @@ import traceback
 from random import choice
 import re
 from .utils.dataIO import DataIO
+from .utils.message_scanner import get_scanner
 from cogs.default import CustomHelpCommand
 
 class AnimemesHelpFormat(CustomHelpCommand):
@@ -30,6 +31,10 @@ class ReadRules(commands.Cog):
     """
     Animemes focused cog
     """
+    rules_channel_id = 366659034410909717
+    iam_memester_regex = re.compile(r'\.?i\s?am\s?meme?(ma)?st[ea]r', re.IGNORECASE)
+    channel_name_regex = re.compile(r"#(\w+-?)+")
+
     async def init_database(self):
         query = '''
                 CREATE TABLE IF NOT EXISTS new_memesters(
@@ -81,20 +86,20 @@ class ReadRules(commands.Cog):
         self.join_log = self.animemes_guild.get_channel(595585060909088774)
         self.bot.loop.create_task(self.init_database())
         self.check_for_new_memester.start()
+        self.scanner = get_scanner(bot)
+        self.scanner.register("readrules", self.on_rules_channel_message,
+                              check=lambda message: message.channel.id == self.rules_channel_id)
 
     def cog_unload(self):
         self.bot.help_command = self._original_help_command
         self.check_for_new_memester.stop()
+        self.scanner.unregister("readrules")
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    async def on_rules_channel_message(self, message, match):
         channel = message.channel
         if message.author.id == self.bot.user.id or not message.guild:
             return
-        if channel.id != 366659034410909717:
-            return
-        iam_memester_regex = re.compile(r'\.?i\s?am\s?meme?(ma)?st[ea]r', re.IGNORECASE)
-        if iam_memester_regex.match(message.clean_content):
+        if self.iam_memester_regex.match(message.clean_content):
             await message.author.add_roles(self.new_memester)
             await message.delete()
             await self.join_log.send(f"{message.author.mention} joined the server.")
@@ -125,7 +130,7 @@ class ReadRules(commands.Cog):
                     return
                 await channel.send(choice(phrases["shack"]))
                 return
-            if "general-discussion" in content or re.match(r"#(\w+-?)+", content) or message.channel_mentions:
+            if "general-discussion" in content or self.channel_name_regex.match(content) or message.channel_mentions:
                 if self.bucket.update_rate_limit(message):
                     await channel.send(choice(phrases['repeat']))
                     return
@@ -1,12 +1,23 @@
 import json
-import aiohttp
-import re
 import datetime
 import discord
 from discord.ext import commands, tasks
 from os import path
 from .utils import checks
+from .utils.http import get_session
+from .utils.message_scanner import get_scanner
+from .utils.reddit_client import PostResolver, RedditClient, REDDIT_LINK_REGEX
+import aiohttp
 import asyncio
+import logging
+
+# reddit has two sticky slots per subreddit
+STICKY_SLOTS = (1, 2)
+# back filling the stickied comment of an announcement, the delay doubles after every attempt
+BACKFILL_FIRST_DELAY = 30
+BACKFILL_MAX_DELAY = 1800
+BACKFILL_ATTEMPTS = 8
+MAX_BACKFILL_JOBS = 4
 
 
 class Reddit(commands.Cog):
@@ -21,10 +32,10 @@ class Reddit(commands.Cog):
             if self.credentials:
                 self.client_id = self.credentials['client_id']
                 self.secret = self.credentials['client_secret']
-                self.auth = aiohttp.BasicAuth(self.client_id, self.secret)
-                self.headers = {'User-Agent': 'Discord Bot by /u/Saikimo',
-                                'Content-Type': 'application/json'}
-            self.session = aiohttp.ClientSession()
+            self.session = get_session(bot)
+            self.client = RedditClient(self.session, self.client_id, self.secret,
+                                       user_agent='Discord Bot by /u/Saikimo')
+            self.resolver = PostResolver(self.client)
             self.reddit_settings_path = "data/reddit_settings.json"
             self.checker_channel = None
             if not path.exists(self.reddit_settings_path):
@@ -35,12 +46,23 @@ class Reddit(commands.Cog):
                 self.checker_channel = self.bot.get_channel(settings['channel'])
                 self.reddit_channel = self.bot.get_channel(settings.get("reddit_channel", None))
             self.last_stickied_post_time = datetime.datetime.utcnow()
+            # ids of announced stickied threads, None until they are loaded from the table
+            self.known_stickies = None
+            # False until the stickies present when the watcher first ran were recorded without announcing them
+            self.primed = False
+            self.logger = logging.getLogger('PoutyBot')
+            self.sticky_etags = dict()
+            self.backfill_jobs = dict()
             self.check_reddit_for_pinned_threads.start()
             self.bot.loop.create_task(self.create_last_posts_table())
+            self.scanner = get_scanner(bot)
+            self.scanner.register("reddit_link", self.on_reddit_link, pattern=REDDIT_LINK_REGEX)
 
     def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
         self.check_reddit_for_pinned_threads.stop()
+        self.scanner.unregister("reddit_link")
+        for job in self.backfill_jobs.values():
+            job.cancel()
 
     async def create_last_posts_table(self):
         async with self.bot.db.acquire() as connection:
@@ -49,6 +71,18 @@ class Reddit(commands.Cog):
                     "created timestamp)"
             async with connection.transaction():
                 await connection.execute(query)
+                await connection.execute("CREATE TABLE IF NOT EXISTS sticky_watcher(primed boolean NOT NULL)")
+            primed = await connection.fetchval("SELECT primed FROM sticky_watcher")
+        self.known_stickies = {row["post_id"] for row in await self.fetch_last_stickied_entries()}
+        # tables filled before the flag existed were primed already
+        self.primed = bool(primed) or bool(self.known_stickies)
+
+    async def set_primed(self):
+        async with self.bot.db.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("DELETE FROM sticky_watcher")
+                await connection.execute("INSERT INTO sticky_watcher VALUES (true)")
+        self.primed = True
 
     async def fetch_last_stickied_entries(self):
         query = "SELECT post_id, created from stickied_threads"
@@ -76,155 +110,162 @@ class Reddit(commands.Cog):
         await ctx.send(f"{ctx.channel.mention} set up as the reddit channel for announcements")
 
     async def edit_embed_with_info(self, permalink, message):
+        """fills in the stickied comment once it was posted, gives up after BACKFILL_ATTEMPTS tries"""
         post_obj = {"permalink": permalink}
-        comment = await self.get_stickied_comment(post_obj)
-        while not comment:
-            await asyncio.sleep(30)
-            comment = await self.get_stickied_comment(post_obj)
-        embed = message.embeds[0]
-        embed.description = comment["data"]["body"][:500]+"..."
-        await message.edit(embed=embed)
+        delay = BACKFILL_FIRST_DELAY
+        for _ in range(BACKFILL_ATTEMPTS):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BACKFILL_MAX_DELAY)
+            try:
+                comment = await self.get_stickied_comment(post_obj)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+            if comment:
+                embed = message.embeds[0]
+                embed.description = comment["data"]["body"][:500]+"..."
+                await message.edit(embed=embed)
+                return
+
+    def start_backfill(self, permalink, message):
+        if len(self.backfill_jobs) >= MAX_BACKFILL_JOBS:
+            oldest = next(iter(self.backfill_jobs))
+            self.backfill_jobs.pop(oldest).cancel()
+        job = self.bot.loop.create_task(self.edit_embed_with_info(permalink, message))
+        self.backfill_jobs[message.id] = job
+        job.add_done_callback(lambda _: self.backfill_jobs.pop(message.id, None))
+
+    async def fetch_sticky(self, slot):
+        """
+        post, stickied comment and etag of a sticky slot.
+        None if the slot is empty or didn't change since the etag was stored
+        """
+        headers = dict()
+        if slot in self.sticky_etags:
+            headers["If-None-Match"] = self.sticky_etags[slot]
+        async with self.client.get("/r/Animemes/about/sticky", params={"num": slot}, headers=headers) as resp:
+            # a server error doesn't mean the slot is empty
+            if resp.status >= 500:
+                resp.raise_for_status()
+            if resp.status != 200:
+                return None
+            etag = resp.headers.get("ETag")
+            resp_data = await resp.json()
+        try:
+            post = resp_data[0]["data"]["children"][0]["data"]
+            stickied_comment = next((comment for comment in resp_data[1]["data"]["children"]
+                                     if comment["data"].get("stickied")), None)
+        except (KeyError, IndexError, TypeError):
+            # not the listing pair of a thread
+            return None
+        return post, stickied_comment, etag
 
     @tasks.loop(minutes=1)
     async def check_reddit_for_pinned_threads(self):
-        async with self.session.get(url="https://reddit.com/r/Animemes.json", auth=self.auth,
-                                    headers=self.headers) as resp:
-            if resp.status == 200:
-                resp_data = await resp.json()
-                stickied_post = [post['data'] for post in resp_data["data"]["children"] if post['data']["stickied"]]
-                last_posts = await self.fetch_last_stickied_entries()
-                if not last_posts:
-                    for post in stickied_post:
-                        post_creation = datetime.datetime.utcnow()
-                        await self.insert_post(post["id"], post_creation)
-                for post in stickied_post:
-                    post_creation = datetime.datetime.utcnow()
-                    if post["id"] not in [p["post_id"] for p in last_posts]:
-                        embed = await self.build_embed_for_stickied_thread(post)
-                        if embed:
-                            sent_message = await self.reddit_channel.send(embed=embed)
-                            await self.insert_post(post["id"], post_creation)
-                            if embed.description == '\u200b':
-                                await self.edit_embed_with_info(post["permalink"], sent_message)
+        if self.known_stickies is None:
+            return
+        # the first check only records the current stickies, it is repeated until every slot was read
+        announce = self.primed
+        complete = True
+        for slot in STICKY_SLOTS:
+            try:
+                complete = await self.check_sticky_slot(slot, announce) and complete
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the loop would stop for good, the slot is tried again next time
+                complete = False
+                if not isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                    self.logger.exception(f"checking sticky slot {slot} failed")
+        if not announce and complete:
+            await self.set_primed()
+
+    async def check_sticky_slot(self, slot, announce):
+        """:return: whether the slot was handled, False if it has to be tried again"""
+        sticky = await self.fetch_sticky(slot)
+        if not sticky:
+            return True
+        post, stickied_comment, etag = sticky
+        if post["id"] not in self.known_stickies:
+            if announce:
+                embed = await self.build_embed_for_stickied_thread(post, stickied_comment)
+                if not embed:
+                    return False
+                sent_message = await self.reddit_channel.send(embed=embed)
+                if embed.description == '\u200b':
+                    self.start_backfill(post["permalink"], sent_message)
+            await self.insert_post(post["id"], datetime.datetime.utcnow())
+            self.known_stickies.add(post["id"])
+        # only stored once the post was handled, so a failed announcement is retried
+        if etag:
+            self.sticky_etags[slot] = etag
+        return True
 
     async def get_stickied_comment(self, post):
-        async with self.session.get(url=f"https://reddit.com{post['permalink']}.json") as resp:
-            if resp.status == 200:
-                json_data = await resp.json()
-                try:
-                    return next(comment for comment in json_data[1]["data"]["children"] if comment["data"]["stickied"])
-                except StopIteration:
-                    return None
+        json_data = await self.client.get_json(post['permalink'])
+        if not json_data:
+            return None
+        try:
+            return next(comment for comment in json_data[1]["data"]["children"] if comment["data"]["stickied"])
+        except StopIteration:
+            return None
+
+    async def build_embed_for_stickied_thread(self, post, stickied_comment=None):
+        sub_data = await self.client.subreddit_about("Animemes")
+        if not sub_data:
+            return None
+        if post["is_self"]:
+            embed = discord.Embed(title=post["title"], timestamp=datetime.datetime.utcfromtimestamp(post["created_utc"]),
+                                  url=post["url"], description=post["selftext"][:500]+"...",
+                                  color=discord.Colour(int(sub_data["primary_color"].strip("#"), 16)))
+            embed.set_thumbnail(url=sub_data["header_img"])
+        else:
+            embed = discord.Embed(title=post["title"],
+                                  timestamp=datetime.datetime.utcfromtimestamp(post["created_utc"]),
+                                  url=f"https://reddit.com{post['permalink']}",
+                                  color=discord.Colour(int(sub_data["primary_color"].strip("#"), 16)),
+                                  description=stickied_comment["data"]["body"][:500]+"..." if stickied_comment
+                                  else "\u200b")
+            if post["over_18"]:
+                embed.set_thumbnail(url=sub_data["header_img"])
+            elif "image" in post["post_hint"]:
+                embed.set_image(url=post["url"])
+            elif post["thumbnail"] != "default" and post["thumbnail"] != "spoiler":
+                embed.set_thumbnail(url=post["thumbnail"])
             else:
-                return None
+                embed.set_thumbnail(url=sub_data["header_img"])
 
-    async def build_embed_for_stickied_thread(self, post):
-        async with self.session.get(url="https://reddit.com/r/Animemes/about.json", auth=self.auth,
-                                    headers=self.headers) as resp:
-            if resp.status == 200:
-                resp_data = await resp.json()
-                sub_data = resp_data["data"]
-                if post["is_self"]:
-                    embed = discord.Embed(title=post["title"], timestamp=datetime.datetime.utcfromtimestamp(post["created_utc"]),
-                                          url=post["url"], description=post["selftext"][:500]+"...",
-                                          color=discord.Colour(int(sub_data["primary_color"].strip("#"), 16)))
-                    embed.set_thumbnail(url=sub_data["header_img"])
-                else:
-                    stickied_comment = await self.get_stickied_comment(post)
-                    embed = discord.Embed(title=post["title"],
-                                          timestamp=datetime.datetime.utcfromtimestamp(post["created_utc"]),
-                                          url=f"https://reddit.com{post['permalink']}",
-                                          color=discord.Colour(int(sub_data["primary_color"].strip("#"), 16)),
-                                          description=stickied_comment["data"]["body"][:500]+"..." if stickied_comment
-                                          else "\u200b")
-                    if post["over_18"]:
-                        embed.set_thumbnail(url=sub_data["header_img"])
-                    elif "image" in post["post_hint"]:
-                        embed.set_image(url=post["url"])
-                    elif post["thumbnail"] != "default" and post["thumbnail"] != "spoiler":
-                        embed.set_thumbnail(url=post["thumbnail"])
-                    else:
-                        embed.set_thumbnail(url=sub_data["header_img"])
-
-                embed.set_author(name=post["author"], url=f"https://reddit.com/user/{post['author']}")
-                embed.set_footer(icon_url=sub_data["icon_img"], text="Animemes")
-                return embed
+        embed.set_author(name=post["author"], url=f"https://reddit.com/user/{post['author']}")
+        embed.set_footer(icon_url=sub_data["icon_img"], text="Animemes")
+        return embed
 
 
     @commands.Cog.listener()
     async def on_message_edit(self, before, after):
-        contains_reddit_link_regex = re.compile("https://(\w+\.)?redd\.?it(.com/(r/\w+/)?comments)?/(\w+)",
-                                                re.MULTILINE)
-        match = contains_reddit_link_regex.search(after.content)
-        if not match:
+        # embeds being added also count as edits, those were checked by on_reddit_link already
+        if before.content == after.content:
             return
-        if match.group(1) and match.group(1).startswith('v'):
-            vid_url = match.string[match.span()[0]: match.span()[1]]
-            async with self.session.get(url=vid_url, auth=self.auth, headers=self.headers) as response:
-                if response.status == 200:
-                    url = str(response.url) + '.json'
-        else:
-            url = "https://reddit.com/comments/" + match.group(4) + ".json"
-        async with self.session.get(url=url, auth=self.auth, headers=self.headers) as response:
-            if response.status == 200:
-                json_dump = await response.json()
-                post_data = json_dump[0]['data']['children'][0]['data']
-                creation_time = datetime.datetime.utcfromtimestamp(int(post_data['created_utc']))
-                now = datetime.datetime.utcnow()
-                difference = now - creation_time
-                subreddit = post_data['subreddit']
-                is_stickied = post_data['stickied']
-                removed_by_category = post_data['removed_by_category']
-
-                if not subreddit == "Animemes":
-                    return
-                if removed_by_category:
-                    return
-                if difference.total_seconds() < 12 * 3600 and not is_stickied:
-                    await after.delete()
-                    await after.channel.send(after.author.mention + " reddit thread automatically removed because " +
-                                             "it is too recent **(Discord server rule 3)**")
-                    if self.checker_channel:
-                        await self.checker_channel.send(
-                            "Warned {0}\nposted a reddit link that was too recent".format(after.author.mention))
+        match = REDDIT_LINK_REGEX.search(after.content)
+        if match:
+            await self.on_reddit_link(after, match)
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        contains_reddit_link_regex = re.compile("https://(\w+\.)?redd\.?it(.com/(r/\w+/)?comments)?/(\w+)",
-                                                re.MULTILINE)
-        match = contains_reddit_link_regex.search(message.content)
-        url = message.content
-        if not match:
+    async def on_reddit_link(self, message, match):
+        post = await self.resolver.resolve(match.group(0))
+        if not post:
             return
-        if match.group(1) and match.group(1).startswith('v'):
-            vid_url = match.string[match.span()[0]: match.span()[1]]
-            async with self.session.get(url=vid_url, auth=self.auth, headers=self.headers) as response:
-                if response.status == 200:
-                    url = str(response.url) + '.json'
-        else:
-            url = "https://reddit.com/comments/" + match.group(4) + ".json"
-        async with self.session.get(url=url, auth=self.auth, headers=self.headers) as response:
-            if response.status == 200:
-                json_dump = await response.json()
-                post_data = json_dump[0]['data']['children'][0]['data']
-                creation_time = datetime.datetime.utcfromtimestamp(int(post_data['created_utc']))
-                now = datetime.datetime.utcnow()
-                difference = now - creation_time
-                subreddit = post_data['subreddit']
-                is_stickied = post_data['stickied']
-                removed_by_category = post_data['removed_by_category']
-                if not subreddit == "Animemes":
-                    return
-                if removed_by_category:
-                    return
-                if difference.total_seconds() < 12 * 3600 and not is_stickied:
-                    await message.delete()
-                    await message.channel.send(
-                        message.author.mention + " reddit thread automatically removed because " +
-                        "it is too recent **(Discord server rule 3)**")
-                    if self.checker_channel:
-                        await self.checker_channel.send(
-                            "Warned {0}\nposted a reddit link that was too recent".format(message.author.mention))
+        if not post['subreddit'] == "Animemes":
+            return
+        if post['removed_by_category']:
+            return
+        creation_time = datetime.datetime.utcfromtimestamp(int(post['created_utc']))
+        difference = datetime.datetime.utcnow() - creation_time
+        if difference.total_seconds() < 12 * 3600 and not post['stickied']:
+            await message.delete()
+            await message.channel.send(
+                message.author.mention + " reddit thread automatically removed because " +
+                "it is too recent **(Discord server rule 3)**")
+            if self.checker_channel:
+                await self.checker_channel.send(
+                    "Warned {0}\nposted a reddit link that was too recent".format(message.author.mention))
 
     @checks.is_owner_or_moderator()
     @commands.command(pass_context=True, hidden=True)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import asyncio
+import time
+
+
+class AsyncTTLCache:
+    """
+    size bounded LRU cache where every entry expires after `ttl` seconds.
+    concurrent lookups of a key that isn't cached yet share one in-flight fetch.
+    None results and exceptions are not cached
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = dict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_fetch(self, key, fetch, ttl: float = None):
+        """
+        returns the cached value of key, otherwise awaits fetch() and caches the result
+        :param fetch: coroutine function without arguments
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved in case nobody else waited for it
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
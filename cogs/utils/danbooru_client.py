@@ -0,0 +1,106 @@
+from contextlib import asynccontextmanager
+from functools import partial
+from .http import get_session
+from .ratelimit import TokenBucket
+import aiohttp
+import json
+import os
+
+# danbooru allows 10 read requests per second per account, stay below that
+DANBOORU_REQUESTS_PER_SECOND = 5
+DANBOORU_REQUEST_BURST = 10
+MAX_CONNECTIONS = 10
+# tags per search allowed for basic accounts, used until the profile was read
+DEFAULT_TAG_QUERY_LIMIT = 2
+
+
+class DanbooruClient:
+    """
+    shared client for the danbooru api
+    the credentials are loaded once and reloaded when the file changes,
+    every request goes through one keep-alive session and one rate limit bucket.
+    inside the bot the session is the bot wide one, fetched for every request so a recreated session is picked up.
+    standalone the client opens its own
+    """
+    base_url = 'https://danbooru.donmai.us'
+
+    def __init__(self, auth_file='data/danbooru/danbooru.json', session_getter=None):
+        # json file with api key and user name for danbooru
+        # Structure:
+        # {
+        #  "user": "username",
+        #  "api_key": "ValidApiKey123"
+        # }
+        self.auth_file = auth_file
+        self.bucket = TokenBucket(DANBOORU_REQUESTS_PER_SECOND, DANBOORU_REQUEST_BURST)
+        self._auth = None
+        self._auth_mtime = None
+        # returns the borrowed session, which is left open by close()
+        self._session_getter = session_getter
+        self._session = None
+        self._tag_query_limit = None
+
+    @property
+    def auth(self):
+        try:
+            mtime = os.stat(self.auth_file).st_mtime
+        except FileNotFoundError:
+            return None
+        if mtime != self._auth_mtime:
+            with open(self.auth_file) as file:
+                data = json.load(file)
+            self._auth = aiohttp.BasicAuth(data['user'], data['api_key'])
+            self._auth_mtime = mtime
+            # another account might have a different tag limit
+            self._tag_query_limit = None
+        return self._auth
+
+    @property
+    def session(self):
+        if self._session_getter is not None:
+            return self._session_getter()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS,
+                                             keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def build_url(self, url: str):
+        if url.startswith("http"):
+            return url
+        if url[0] != "/":
+            url = "/" + url
+        return self.base_url + url
+
+    @asynccontextmanager
+    async def get(self, url, **kwargs):
+        """rate limited, authenticated GET request, url can be relative to the danbooru base url"""
+        await self.bucket.acquire()
+        kwargs.setdefault('auth', self.auth)
+        async with self.session.get(self.build_url(url), **kwargs) as response:
+            yield response
+
+    async def tag_query_limit(self):
+        """returns how many tags the account may use in a single search"""
+        if self.auth is None:
+            return DEFAULT_TAG_QUERY_LIMIT
+        if self._tag_query_limit is None:
+            async with self.get('/profile.json') as response:
+                if response.status != 200:
+                    return DEFAULT_TAG_QUERY_LIMIT
+                profile = await response.json()
+            self._tag_query_limit = profile.get('tag_query_limit', DEFAULT_TAG_QUERY_LIMIT)
+        return self._tag_query_limit
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+
+def get_client(bot):
+    """returns the danbooru client shared by all cogs, so reloading a cog keeps the connections"""
+    client = getattr(bot, 'danbooru_client', None)
+    if client is None:
+        client = DanbooruClient(session_getter=partial(get_session, bot))
+        bot.danbooru_client = client
+    return client
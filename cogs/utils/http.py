@@ -0,0 +1,91 @@
+from collections import deque
+import aiohttp
+import asyncio
+import time
+
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 10
+DNS_CACHE_SECONDS = 300
+KEEPALIVE_SECONDS = 30
+# latencies per host kept for the percentiles
+LATENCY_SAMPLES = 200
+
+
+class HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+class HttpMetrics:
+    """request count, failures (exceptions and 5xx answers) and latency per host, fed by a TraceConfig"""
+
+    def __init__(self):
+        self.hosts = dict()
+
+    def _host(self, host):
+        metrics = self.hosts.get(host)
+        if metrics is None:
+            metrics = HostMetrics()
+            self.hosts[host] = metrics
+        return metrics
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        context.start = time.monotonic()
+
+    async def _on_request_end(self, session, context, params):
+        metrics = self._host(params.url.host)
+        metrics.requests += 1
+        metrics.latencies.append(time.monotonic() - context.start)
+        if params.response.status >= 500:
+            metrics.failures += 1
+
+    async def _on_request_exception(self, session, context, params):
+        metrics = self._host(params.url.host)
+        metrics.requests += 1
+        metrics.failures += 1
+
+
+def create_session(metrics: HttpMetrics = None):
+    """
+    client session tuned for the whole bot: connections are kept alive and limited per host,
+    dns answers are cached and every request is recorded in metrics.
+    the timeout stays the aiohttp default, requests that need a shorter one pass their own.
+    aiohttp only speaks HTTP/1.1, keep-alive is what saves the handshakes instead of HTTP/2
+    """
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                                     ttl_dns_cache=DNS_CACHE_SECONDS, keepalive_timeout=KEEPALIVE_SECONDS)
+    trace_configs = [metrics.trace_config()] if metrics else None
+    return aiohttp.ClientSession(connector=connector, trace_configs=trace_configs)
+
+
+def get_session(bot):
+    """returns the http session shared by all cogs, its metrics are in bot.http_metrics. cogs must not close it"""
+    session = getattr(bot, 'http_session', None)
+    if session is None or session.closed:
+        bot.http_metrics = HttpMetrics()
+        session = create_session(bot.http_metrics)
+        bot.http_session = session
+    return session
+
+
+async def close_session(bot):
+    session = getattr(bot, 'http_session', None)
+    if session is not None:
+        await session.close()
+        # give the connector time to close the ssl transports
+        await asyncio.sleep(0.25)
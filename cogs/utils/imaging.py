@@ -0,0 +1,331 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageSequence
+import asyncio
+import hashlib
+import io
+import math
+import os
+import sys
+import time
+
+# formats pillow writes back in the format they came in, everything else becomes a png
+OUTPUT_FORMATS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'WEBP': 'webp'}
+# animations with more frames get frames dropped and larger frames of animations get scaled down,
+# still images keep their size. None disables the cap
+MAX_FRAMES = 150
+MAX_FRAME_SIZE = 1024
+# how often the output is scaled down to fit discord's upload limit before giving up
+MAX_SHRINK_ATTEMPTS = 4
+# reverse image search uploads
+SEARCH_UPLOAD_BYTES = 1000000
+SEARCH_MAX_DIMENSION = 1280
+BYTES_PER_PIXEL = 0.3
+
+
+class Frames:
+    """decoded image, every frame is stored as a quickly compressed png so it can be handed to workers"""
+
+    def __init__(self, frames, durations, image_format, loop=0):
+        self.frames = frames
+        self.durations = durations
+        self.image_format = image_format
+        self.loop = loop
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.image_format]
+
+
+def _to_png(frame):
+    output = io.BytesIO()
+    frame.save(output, format='PNG', compress_level=1)
+    return output.getvalue()
+
+
+def _from_png(data):
+    return Image.open(io.BytesIO(data)).convert('RGBA')
+
+
+def split_frames(data: bytes, max_frames: int = MAX_FRAMES, max_size: int = MAX_FRAME_SIZE):
+    """
+    decodes an image or animation into its frames with their delays in milliseconds
+    animations above max_frames keep every n-th frame with the delays of the dropped ones added up,
+    frames of animations larger than max_size are scaled down. still images are never scaled
+    """
+    image = Image.open(io.BytesIO(data))
+    image_format = image.format if image.format in OUTPUT_FORMATS else 'PNG'
+    n_frames = getattr(image, 'n_frames', 1)
+    step = 1
+    if max_frames and n_frames > max_frames:
+        step = math.ceil(n_frames / max_frames)
+    frames = list()
+    durations = list()
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = frame.info.get('duration', 100)
+        if index % step:
+            durations[-1] += duration
+            continue
+        frame = frame.convert('RGBA')
+        if max_size and n_frames > 1 and max(frame.size) > max_size:
+            frame.thumbnail((max_size, max_size), Image.LANCZOS)
+        frames.append(_to_png(frame))
+        durations.append(duration)
+    return Frames(frames, durations, image_format, image.info.get('loop', 0))
+
+
+def join_frames(frames: Frames, scale: float = 1):
+    """encodes the frames back into their original format, returns the bytes and the file extension"""
+    images = [_from_png(frame) for frame in frames.frames]
+    if scale != 1:
+        size = (max(1, int(images[0].width * scale)), max(1, int(images[0].height * scale)))
+        images = [image.resize(size, Image.LANCZOS) for image in images]
+    output = io.BytesIO()
+    if len(images) > 1 and frames.image_format in ('GIF', 'PNG', 'WEBP'):
+        images[0].save(output, format=frames.image_format, save_all=True, append_images=images[1:],
+                       duration=frames.durations, loop=frames.loop, disposal=2)
+    elif frames.image_format == 'JPEG':
+        images[0].convert('RGB').save(output, format='JPEG', quality=90)
+    else:
+        images[0].save(output, format=frames.image_format)
+    return output.getvalue(), frames.extension
+
+
+def rotational_blur(frame: bytes, angle: float):
+    """averages copies of the png frame rotated around its center over `angle` degrees, runs in a worker process"""
+    frame = _from_png(frame)
+    samples = max(3, int(angle * 2) + 1)
+    blurred = frame
+    for i in range(samples):
+        rotation = -angle / 2 + angle * i / (samples - 1)
+        rotated = frame.rotate(rotation, resample=Image.BILINEAR)
+        # corners rotated into view take the pixels of the unrotated frame, like imagemagick's edge pixels
+        rotated = Image.alpha_composite(frame, rotated)
+        # running average, every sample ends up with the same weight
+        blurred = Image.blend(blurred, rotated, 1 / (i + 1))
+    return _to_png(blurred)
+
+
+def _fit_jpeg(image, max_bytes, min_quality=40, max_quality=95):
+    """binary search for the highest jpeg quality below max_bytes, None if even min_quality is too big"""
+    best = None
+    while min_quality <= max_quality:
+        quality = (min_quality + max_quality) // 2
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality)
+        if output.tell() <= max_bytes:
+            best = output.getvalue()
+            min_quality = quality + 1
+        else:
+            max_quality = quality - 1
+    return best
+
+
+def downscale_to_budget(data: bytes, max_bytes: int = SEARCH_UPLOAD_BYTES,
+                        max_dimension: int = SEARCH_MAX_DIMENSION):
+    """
+    shrinks an image for reverse image search uploads, runs in an executor
+    images that already fit are returned as they are, everything else becomes a jpeg below max_bytes.
+    jpegs are decoded at a reduced scale right away, which skips most of the decoding work
+    :return: image bytes
+    """
+    image = Image.open(io.BytesIO(data))
+    animated = getattr(image, 'is_animated', False)
+    if len(data) <= max_bytes and max(image.size) <= max_dimension and not animated \
+            and image.format in ('JPEG', 'PNG'):
+        return data
+    width, height = image.size
+    # a jpeg of a photo needs around a third of a byte per pixel
+    scale = min(1, max_dimension / max(width, height), math.sqrt(max_bytes / BYTES_PER_PIXEL / (width * height)))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if image.format == 'JPEG':
+        # lets libjpeg decode at 1/2, 1/4 or 1/8 of the size, but never below target
+        image.draft('RGB', target)
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    image = image.convert('RGB')
+    while True:
+        if image.size != target:
+            image = image.resize(target, Image.LANCZOS)
+        output = _fit_jpeg(image, max_bytes)
+        if output is not None or max(target) <= 64:
+            return output if output is not None else _fit_jpeg(image, float('inf'), 40, 40)
+        target = (max(1, int(target[0] * 0.75)), max(1, int(target[1] * 0.75)))
+
+
+async def downscale_for_search(data: bytes, max_bytes: int = SEARCH_UPLOAD_BYTES):
+    """downscale_to_budget in the default executor, so decoding doesn't block the event loop"""
+    return await asyncio.get_event_loop().run_in_executor(None, downscale_to_budget, data, max_bytes)
+
+
+class ImagePipeline:
+    """
+    runs image effects on in-memory buffers.
+    animations are split into frames which are processed in parallel and joined with their original delays.
+    pillow effects run in a process pool with one worker per core,
+    liquid rescale is left to imagemagick which gets the frames through pipes and
+    runs at most one process per core
+    """
+
+    def __init__(self, workers: int = None, max_frames: int = MAX_FRAMES, max_frame_size: int = MAX_FRAME_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_frames = max_frames
+        self.max_frame_size = max_frame_size
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.magick_semaphore = asyncio.Semaphore(self.workers)
+        if 'win32' in sys.platform:
+            self.image_magick_command = "magick"
+        else:
+            self.image_magick_command = "convert"
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.pool, func, *args)
+
+    async def map_frames(self, data: bytes, process_frame):
+        """applies the coroutine function process_frame to every frame concurrently"""
+        # memoryviews can't be pickled for the worker processes
+        frames = await self.run(split_frames, bytes(data), self.max_frames, self.max_frame_size)
+        frames.frames = await asyncio.gather(*[process_frame(frame) for frame in frames.frames])
+        return await self.run(join_frames, frames)
+
+    async def blur(self, data: bytes, intensity: int):
+        """:return: encoded image and its file extension"""
+        return await self.map_frames(data, lambda frame: self.run(rotational_blur, frame, intensity))
+
+    async def distort(self, data: bytes):
+        """:return: encoded image and its file extension"""
+        return await self.map_frames(data, self.liquid_rescale)
+
+    async def liquid_rescale(self, frame: bytes):
+        """distorts a png frame with imagemagick's seam carving"""
+        async with self.magick_semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                self.image_magick_command, 'png:-', '-liquid-rescale', '50%x50%', '-resize', '200%', 'png:-',
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            output, error = await proc.communicate(frame)
+        if proc.returncode != 0:
+            raise RuntimeError(error.decode(errors='replace').strip() or 'imagemagick failed')
+        return output
+
+    async def shrink_to_fit(self, data: bytes, limit: int):
+        """
+        scales the image down until it is smaller than limit bytes
+        :return: encoded image and its file extension, None if it doesn't fit
+        """
+        frames = await self.run(split_frames, data, None, None)
+        size = len(data)
+        scale = 1
+        for _ in range(MAX_SHRINK_ATTEMPTS):
+            # the file size shrinks roughly with the pixel count, aim a bit below the limit
+            scale *= math.sqrt(limit / size) * 0.9
+            data, extension = await self.run(join_frames, frames, scale)
+            size = len(data)
+            if size < limit:
+                return data, extension
+        return None
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+class ResultCache:
+    """
+    content addressed cache of rendered images on disk.
+    entries are named after the hash of the source image plus the operation and its parameters,
+    the least recently used ones are deleted once the directory grows above max_bytes.
+    the discord url of an uploaded result is kept as well, so repeats can link the upload instead
+    """
+    # discord attachment links are signed and stop working after about a day
+    url_ttl = 12 * 60 * 60
+
+    def __init__(self, directory: str = 'data/image_cache', max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.urls = dict()
+        self.entries = OrderedDict()
+        files = [entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            key, _, extension = entry.name.rpartition('.')
+            # not written by the cache
+            if not key or not extension:
+                continue
+            if key in self.entries:
+                # an older result of the same key in another format
+                self._remove_file(key, self.entries.pop(key)[0])
+            self.entries[key] = (extension, entry.stat().st_size)
+        self.size = sum(size for _, size in self.entries.values())
+
+    @staticmethod
+    def key(source: bytes, operation: str, *params):
+        digest = hashlib.sha256(source).hexdigest()
+        return '-'.join([operation, *map(str, params), digest])
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, f'{key}.{extension}')
+
+    def get_url(self, key):
+        url, expires = self.urls.get(key, (None, 0))
+        if expires < time.time():
+            self.urls.pop(key, None)
+            return None
+        return url
+
+    def set_url(self, key, url):
+        self.urls[key] = (url, time.time() + self.url_ttl)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # the modification time keeps the lru order across restarts
+        os.utime(path)
+        return data
+
+    def _write(self, path, data):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    async def get(self, key):
+        """:return: cached image and its file extension, None if it isn't cached"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        extension, _ = entry
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, self._read, self._path(key, extension))
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        self.entries.move_to_end(key)
+        return data, extension
+
+    async def put(self, key, data: bytes, extension: str):
+        if len(data) > self.max_bytes:
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self._write, self._path(key, extension), data)
+        previous = self.entries.get(key)
+        self._forget(key)
+        if previous is not None and previous[0] != extension:
+            self._remove_file(key, previous[0])
+        self.entries[key] = (extension, len(data))
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            extension, _ = self.entries[oldest]
+            self._forget(oldest)
+            self._remove_file(oldest, extension)
+
+    def _remove_file(self, key, extension):
+        try:
+            os.remove(self._path(key, extension))
+        except FileNotFoundError:
+            pass
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        self.urls.pop(key, None)
@@ -0,0 +1,140 @@
+import aiohttp
+import asyncio
+import io
+
+# discord's default upload limit, nothing bigger can be posted back anyway
+MAX_MEDIA_BYTES = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# seconds until the whole download has to be done and between two received chunks
+DOWNLOAD_TIMEOUT = 30
+READ_TIMEOUT = 10
+
+# (offset, magic bytes, mime type, file extension)
+SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png', 'png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg', 'jpg'),
+    (0, b'GIF87a', 'image/gif', 'gif'),
+    (0, b'GIF89a', 'image/gif', 'gif'),
+    (0, b'BM', 'image/bmp', 'bmp'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm', 'webm'),
+    (4, b'ftyp', 'video/mp4', 'mp4'),
+]
+
+
+class MediaError(Exception):
+    """the media couldn't be fetched, the message can be shown to the user"""
+    pass
+
+
+class Media:
+    """downloaded file, data is a memoryview of the downloaded bytes"""
+
+    def __init__(self, data: memoryview, mime_type: str, extension: str):
+        self.data = data
+        self.mime_type = mime_type
+        self.extension = extension
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def is_image(self):
+        return self.mime_type.startswith('image/')
+
+    @property
+    def is_video(self):
+        return self.mime_type.startswith('video/')
+
+
+def sniff(head: bytes):
+    """:return: mime type and file extension the magic bytes belong to, (None, None) if unknown"""
+    for offset, magic, mime_type, extension in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type, extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp', 'webp'
+    return None, None
+
+
+async def fetch_media(session: aiohttp.ClientSession, url: str, max_bytes: int = MAX_MEDIA_BYTES,
+                      allowed=('image/',), timeout: float = DOWNLOAD_TIMEOUT):
+    """
+    streams url into memory, stops as soon as the download grows above max_bytes
+    the type is taken from the magic bytes of the file, content type and extension are ignored
+    :param allowed: mime type prefixes that are accepted
+    :raises MediaError: if the download fails, is too big or not an allowed type
+    """
+    client_timeout = aiohttp.ClientTimeout(total=timeout, sock_read=READ_TIMEOUT)
+    buffer = io.BytesIO()
+    mime_type = extension = None
+    try:
+        async with session.get(url, timeout=client_timeout) as response:
+            if response.status != 200:
+                raise MediaError(f"Couldn't download the file (HTTP {response.status}).")
+            if response.content_length and response.content_length > max_bytes:
+                raise MediaError("The file is too big.")
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                buffer.write(chunk)
+                if buffer.tell() > max_bytes:
+                    raise MediaError("The file is too big.")
+                if mime_type is None and buffer.tell() >= 16:
+                    mime_type, extension = sniff(buffer.getvalue()[:16])
+                    if mime_type is None or not mime_type.startswith(tuple(allowed)):
+                        raise MediaError("That file type isn't supported.")
+    except (aiohttp.InvalidURL, ValueError):
+        raise MediaError("That's not a valid link.")
+    except asyncio.TimeoutError:
+        raise MediaError("The download took too long.")
+    except aiohttp.ClientError:
+        raise MediaError("Couldn't download the file.")
+    if mime_type is None:
+        # files below 16 bytes
+        mime_type, extension = sniff(buffer.getvalue())
+        if mime_type is None or not mime_type.startswith(tuple(allowed)):
+            raise MediaError("That file type isn't supported.")
+    return Media(buffer.getbuffer(), mime_type, extension)
+
+
+class FrameExtractor:
+    """
+    grabs a still from a video with ffmpeg, the frame comes back through a pipe.
+    only keyframes are decoded and the thumbnail filter picks the most representative of the first few,
+    which skips black intro frames and is a lot cheaper than decoding every frame
+    """
+    # keyframes the thumbnail filter compares
+    candidate_frames = 5
+
+    def __init__(self, max_processes: int = 2, timeout: float = DOWNLOAD_TIMEOUT):
+        self.semaphore = asyncio.Semaphore(max_processes)
+        self.timeout = timeout
+
+    async def extract(self, url: str):
+        """
+        :return: jpeg bytes of the frame
+        :raises MediaError: if no frame could be read in time
+        """
+        if not url.startswith(('http://', 'https://')):
+            raise MediaError("That's not a valid link.")
+        async with self.semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-loglevel', 'error', '-protocol_whitelist', 'http,https,tcp,tls',
+                    '-skip_frame', 'nokey', '-i', url,
+                    '-vf', f'thumbnail={self.candidate_frames}', '-frames:v', '1',
+                    '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1',
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+                )
+            except FileNotFoundError:
+                raise MediaError("Videos aren't supported right now.")
+            try:
+                frame, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise MediaError("Reading the video took too long.")
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+        if not frame:
+            raise MediaError("Couldn't read a frame from that video.")
+        return frame
@@ -0,0 +1,136 @@
+import asyncio
+import re
+import time
+
+# flags that can be scoped to a single branch of the combined pattern
+SCOPED_FLAGS = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+
+
+class ScanRule:
+    def __init__(self, name, callback, pattern=None, check=None):
+        self.name = name
+        self.callback = callback
+        self.pattern = pattern
+        self.check = check
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class MessageScanner:
+    """
+    single on_message listener shared by the cogs that react to message content.
+    every rule's pattern is part of one combined alternation, so a message without any match is
+    scanned once and only the rules that matched get called. rules without a pattern are called for
+    every message that passes their check.
+    callbacks are called as callback(message, match), match being the rule's own pattern searched
+    on the content (None for rules without a pattern), each in its own task like discord listeners
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.rules = dict()
+        self._combined = None
+        self._group_rules = dict()
+        self._catch_all = []
+        self.messages = 0
+        self.scan_time = 0.0
+        bot.add_listener(self.on_message, 'on_message')
+
+    def register(self, name: str, callback, pattern=None, phrases=None, ignore_case=False, check=None):
+        """
+        :param name: unique rule name, registering the same name again replaces the rule
+        :param pattern: regex string or compiled pattern, without named groups or numbered backreferences
+        :param phrases: literal phrases, alternative to pattern
+        :param check: cheap predicate on the message, evaluated before the callback is scheduled
+        """
+        flags = re.IGNORECASE if ignore_case else 0
+        if phrases:
+            pattern = re.compile('|'.join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)),
+                                 flags)
+        elif isinstance(pattern, str):
+            pattern = re.compile(pattern, flags)
+        self.rules[name] = ScanRule(name, callback, pattern, check)
+        self._rebuild()
+
+    def unregister(self, name: str):
+        if self.rules.pop(name, None):
+            self._rebuild()
+
+    def _rebuild(self):
+        groups = []
+        self._group_rules = dict()
+        self._catch_all = []
+        for index, rule in enumerate(self.rules.values()):
+            if rule.pattern is None:
+                self._catch_all.append(rule)
+                continue
+            group = f'r{index}'
+            self._group_rules[group] = rule
+            source = rule.pattern.pattern
+            # scope the rule's own flags to its branch of the alternation
+            scoped = ''.join(letter for flag, letter in SCOPED_FLAGS if rule.pattern.flags & flag)
+            if scoped:
+                source = f'(?{scoped}:{source})'
+            groups.append(f'(?P<{group}>{source})')
+        self._combined = re.compile('|'.join(groups)) if groups else None
+
+    def scan(self, content: str):
+        """returns the rules whose patterns match content, in registration order"""
+        if self._combined is None:
+            return []
+        matched = set()
+        first = None
+        for match in self._combined.finditer(content):
+            matched.add(match.lastgroup)
+            if first is None:
+                first = match.start()
+        if first is None:
+            return []
+        # the alternation consumes every match for the first branch that fits, so a rule overlapping
+        # another rule's match isn't seen by it. such a match can't start before the first combined
+        # match, the rules that weren't hit are searched on their own from there
+        return [rule for group, rule in self._group_rules.items()
+                if group in matched or rule.pattern.search(content, first)]
+
+    async def on_message(self, message):
+        start = time.perf_counter()
+        rules = [rule for rule in self._catch_all if rule.check is None or rule.check(message)]
+        if message.content:
+            rules += self.scan(message.content)
+        self.messages += 1
+        self.scan_time += time.perf_counter() - start
+        for rule in rules:
+            if rule.pattern is None:
+                match = None
+            elif rule.check is not None and not rule.check(message):
+                continue
+            else:
+                # the rule's own search, groups in the combined pattern are renumbered
+                match = rule.pattern.search(message.content)
+            self.bot.loop.create_task(self._run(rule, message, match))
+
+    async def _run(self, rule, message, match):
+        start = time.perf_counter()
+        try:
+            await rule.callback(message, match)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            rule.errors += 1
+            await self.bot.on_error('on_message', message)
+        finally:
+            elapsed = time.perf_counter() - start
+            rule.calls += 1
+            rule.total_time += elapsed
+            rule.max_time = max(rule.max_time, elapsed)
+
+
+def get_scanner(bot):
+    """returns the message scanner shared by all cogs, cogs unregister their rules in cog_unload"""
+    scanner = getattr(bot, 'message_scanner', None)
+    if scanner is None:
+        scanner = MessageScanner(bot)
+        bot.message_scanner = scanner
+    return scanner
@@ -0,0 +1,85 @@
+from PIL import Image
+import io
+
+HASH_SIZE = 8
+
+
+def dhash(data: bytes, size: int = HASH_SIZE):
+    """
+    difference hash of an image, a size*size bit integer
+    every bit says whether a pixel of the shrunk grayscale image is brighter than its right neighbour,
+    so rescaled or recompressed copies of an image end up with (almost) the same hash
+    """
+    image = Image.open(io.BytesIO(data))
+    # jpegs only get decoded at the smallest scale that still covers the hash
+    image.draft('L', (size * 8, size * 8))
+    image = image.convert('L').resize((size + 1, size), Image.BOX)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a: int, b: int):
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value: int, bits: int = 64):
+    """postgres has no unsigned 64 bit integer"""
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+def to_unsigned(value: int, bits: int = 64):
+    return value + (1 << bits) if value < 0 else value
+
+
+class BKTree:
+    """
+    burkhard-keller tree over hashes with the hamming distance as metric.
+    a search within distance d only descends into children whose edge distance is within d of the
+    distance to the current node, which skips most of the tree for small d
+    """
+
+    def __init__(self):
+        # node: [hash, values, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value_hash: int, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [value_hash, [value], dict()]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value_hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value_hash, [value], dict()]
+                return
+            node = child
+
+    def search(self, value_hash: int, max_distance: int):
+        """:return: list of (distance, value) within max_distance, closest first"""
+        found = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value_hash, node[0])
+            if distance <= max_distance:
+                found += [(distance, value) for value in node[1]]
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
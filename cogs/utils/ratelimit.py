@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    asynchronous token bucket
+    holds up to `capacity` tokens which refill at `rate` tokens per second.
+    acquire() waits until enough tokens are available, waiters are served in order
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
@@ -0,0 +1,154 @@
+from contextlib import asynccontextmanager
+from functools import partial
+from .cache import AsyncTTLCache
+import aiohttp
+import asyncio
+import re
+import time
+
+# links to reddit threads: reddit.com/r/<sub>/comments/<id>, redd.it/<id> and v.redd.it/<video id>
+REDDIT_LINK_REGEX = re.compile(r"https://(\w+\.)?redd\.?it(.com/(r/\w+/)?comments)?/(\w+)", re.MULTILINE)
+COMMENTS_PATH_REGEX = re.compile(r"/comments/(\w+)")
+POST_CACHE_SIZE = 1024
+# stickied and removed_by_category can change, so posts are fetched again after a while
+POST_CACHE_SECONDS = 600
+# video ids never move to another post
+VIDEO_CACHE_SECONDS = 86400
+# colors and icons of a subreddit rarely change
+SUBREDDIT_CACHE_SECONDS = 6 * 3600
+# the token is refreshed this long before it expires
+TOKEN_REFRESH_MARGIN = 60
+# requests kept in reserve of the quota, below that requests wait for the reset
+RATELIMIT_RESERVE = 5
+
+
+class RedditClient:
+    """
+    app only oauth client for the reddit api.
+    the bearer token is fetched with the app credentials and refreshed before it expires,
+    the quota from the X-Ratelimit headers paces requests once it is almost used up
+    """
+    base_url = 'https://oauth.reddit.com'
+    token_url = 'https://www.reddit.com/api/v1/access_token'
+
+    def __init__(self, session: aiohttp.ClientSession, client_id: str, secret: str, user_agent: str):
+        self.session = session
+        self.app_auth = aiohttp.BasicAuth(client_id, secret)
+        self.user_agent = user_agent
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = asyncio.Lock()
+        self.ratelimit_remaining = None
+        self.ratelimit_reset = 0
+        self.subreddits = AsyncTTLCache(maxsize=16, ttl=SUBREDDIT_CACHE_SECONDS)
+
+    async def token(self):
+        async with self._token_lock:
+            if self._token is None or time.monotonic() > self._token_expires - TOKEN_REFRESH_MARGIN:
+                async with self.session.post(self.token_url, auth=self.app_auth,
+                                             data={'grant_type': 'client_credentials'},
+                                             headers={'User-Agent': self.user_agent}) as response:
+                    response.raise_for_status()
+                    data = await response.json()
+                self._token = data['access_token']
+                self._token_expires = time.monotonic() + data['expires_in']
+            return self._token
+
+    def build_url(self, url: str):
+        if url.startswith("http"):
+            return url
+        if url[0] != "/":
+            url = "/" + url
+        return self.base_url + url
+
+    async def _pace(self):
+        if self.ratelimit_remaining is not None and self.ratelimit_remaining <= RATELIMIT_RESERVE:
+            delay = self.ratelimit_reset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def _update_ratelimit(self, response):
+        remaining = response.headers.get('X-Ratelimit-Remaining')
+        reset = response.headers.get('X-Ratelimit-Reset')
+        if remaining is not None and reset is not None:
+            self.ratelimit_remaining = float(remaining)
+            self.ratelimit_reset = time.monotonic() + float(reset)
+
+    @asynccontextmanager
+    async def get(self, url, **kwargs):
+        """paced, authenticated GET request, url can be relative to the oauth api url"""
+        await self._pace()
+        headers = kwargs.pop('headers', {})
+        headers.update({'User-Agent': self.user_agent, 'Authorization': f"bearer {await self.token()}"})
+        params = kwargs.pop('params', {})
+        params.setdefault('raw_json', 1)
+        async with self.session.get(self.build_url(url), headers=headers, params=params, **kwargs) as response:
+            self._update_ratelimit(response)
+            if response.status == 401:
+                # revoked or expired early, the next request gets a new one
+                self._token = None
+            yield response
+
+    async def get_json(self, url, **kwargs):
+        """json of a GET request, None if the status isn't 200"""
+        async with self.get(url, **kwargs) as response:
+            if response.status != 200:
+                return None
+            return await response.json()
+
+    async def subreddit_about(self, subreddit: str):
+        """cached about data of a subreddit (colors, icons, header image)"""
+        return await self.subreddits.get_or_fetch(subreddit.lower(), partial(self._fetch_about, subreddit))
+
+    async def _fetch_about(self, subreddit):
+        about = await self.get_json(f"/r/{subreddit}/about")
+        return about["data"] if about else None
+
+
+class PostResolver:
+    """
+    maps reddit links to the metadata the link moderation needs:
+    id, created_utc, subreddit, stickied and removed_by_category.
+    posts are cached by post id and v.redd.it links by video id, concurrent lookups of the same
+    post share one request
+    """
+
+    def __init__(self, client: RedditClient):
+        self.client = client
+        self.posts = AsyncTTLCache(maxsize=POST_CACHE_SIZE, ttl=POST_CACHE_SECONDS)
+        self.videos = AsyncTTLCache(maxsize=POST_CACHE_SIZE, ttl=VIDEO_CACHE_SECONDS)
+
+    async def resolve(self, url: str):
+        """:return: metadata of the post url links to, None if it isn't a reddit post"""
+        match = REDDIT_LINK_REGEX.search(url)
+        if not match:
+            return None
+        if match.group(1) and match.group(1).startswith('v'):
+            post_id = await self.videos.get_or_fetch(match.group(4), partial(self._follow_video, match.group(0)))
+        else:
+            post_id = match.group(4)
+        if not post_id:
+            return None
+        return await self.posts.get_or_fetch(post_id, partial(self._fetch_post, post_id))
+
+    async def _follow_video(self, video_url):
+        """v.redd.it links redirect to the thread of the video"""
+        # the redirect is on the public site, it doesn't need the token
+        async with self.client.session.get(url=video_url, headers={'User-Agent': self.client.user_agent}) as response:
+            if response.status != 200:
+                return None
+            match = COMMENTS_PATH_REGEX.search(response.url.path)
+            return match.group(1) if match else None
+
+    async def _fetch_post(self, post_id):
+        json_dump = await self.client.get_json(f"/comments/{post_id}")
+        if not json_dump:
+            return None
+        post_data = json_dump[0]['data']['children'][0]['data']
+        return {
+            'id': post_data['id'],
+            'created_utc': post_data['created_utc'],
+            'subreddit': post_data['subreddit'],
+            'stickied': post_data['stickied'],
+            'removed_by_category': post_data['removed_by_category'],
+        }
@@ -0,0 +1,149 @@
+"""
+parsers for the pages scraped by the search commands.
+they return plain lists and dicts so they can run in worker processes and keep the event loop free.
+lxml does the parsing, it is in the requirements. where it can't be installed BeautifulSoup with html.parser
+only builds the part of the page that is needed, which is a lot slower
+"""
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+import asyncio
+import re
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+PARSER_WORKERS = 2
+IQDB_SIMILARITY_REGEX = re.compile(r'(\d+)% similarity')
+WOLFRAM_SUCCESS_REGEX = re.compile(r'<queryresult[^>]*\ssuccess=[\'"](\w+)')
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PARSER_WORKERS)
+    return _pool
+
+
+async def run_parser(parser, text: str):
+    """runs parser(text) in the parser worker pool"""
+    return await asyncio.get_event_loop().run_in_executor(_get_pool(), parser, text)
+
+
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _text(node):
+    return ' '.join(node.text_content().split()) if lxml else node.get_text(' ', strip=True)
+
+
+def parse_iqdb(html: str):
+    """
+    :return: list of {'url', 'similarity', 'relevant'} in page order,
+    matches below iqdb's "No relevant matches" header aren't relevant
+    """
+    if lxml:
+        blocks = lxml.html.fromstring(html).xpath('//div[@id="pages"]/div')
+        find_link = lambda block: next(iter(block.xpath('.//a/@href')), None)
+    else:
+        pages = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(id='pages')).find(id='pages')
+        blocks = pages.find_all('div', recursive=False) if pages else []
+        find_link = lambda block: block.a['href'] if block.a else None
+    matches = []
+    relevant = True
+    # the first block is the uploaded image
+    for block in blocks[1:]:
+        text = _text(block)
+        if 'No relevant matches' in text:
+            relevant = False
+        url = find_link(block)
+        if url is None:
+            continue
+        similarity = IQDB_SIMILARITY_REGEX.search(text)
+        matches.append({'url': url, 'similarity': int(similarity.group(1)) / 100 if similarity else None,
+                        'relevant': relevant})
+    return matches
+
+
+def parse_saucenao(html: str):
+    """:return: list of {'similarity' (percent), 'url', 'content_url', 'title'} in page order"""
+    if lxml:
+        results = lxml.html.fromstring(html).xpath(f'//*[{_has_class("resulttablecontent")}]')
+        select = lambda node, name: node.xpath(f'.//*[{_has_class(name)}]')
+        links = lambda node: node.xpath('.//a/@href')
+    else:
+        soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(class_='resulttablecontent'))
+        results = soup.select('.resulttablecontent')
+        select = lambda node, name: node.select('.' + name)
+        links = lambda node: [link['href'] for link in node.select('a[href]')]
+    parsed = []
+    for result in results:
+        similarity = select(result, 'resultsimilarityinfo')
+        if not similarity:
+            continue
+        content = select(result, 'resultcontentcolumn')
+        title = select(result, 'resulttitle')
+        result_links = links(result)
+        content_links = links(content[0]) if content else []
+        parsed.append({
+            'similarity': float(_text(similarity[0]).rstrip('%')),
+            'url': result_links[0] if result_links else None,
+            'content_url': content_links[0] if content_links else None,
+            'title': _text(title[0]) if title else None,
+        })
+    return parsed
+
+
+def parse_tineye(html: str):
+    """:return: list of {'pages', 'image'} for every match"""
+    if lxml:
+        matches = lxml.html.fromstring(html).xpath(f'//*[{_has_class("match")}]')
+        hidden_nodes = lambda match: match.xpath(f'.//*[{_has_class("hidden-xs")}]')
+    else:
+        soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(class_='match'))
+        matches = soup.find_all(class_='match')
+        hidden_nodes = lambda match: match.select('.hidden-xs')
+    parsed = []
+    for match in matches:
+        pages = []
+        image = None
+        for hidden in hidden_nodes(match):
+            if lxml:
+                starts_with_page = (hidden.text or '').startswith('Page:')
+                sibling = hidden.getnext()
+                link = sibling.get('href') if sibling is not None else None
+                image_links = hidden.xpath('./a/@href')
+                image_link = image_links[0] if image_links else None
+            else:
+                starts_with_page = bool(hidden.contents) and str(hidden.contents[0]).startswith('Page:')
+                sibling = hidden.find_next_sibling()
+                link = sibling.get('href') if sibling is not None else None
+                image_link = hidden.a['href'] if hidden.a else None
+            if starts_with_page:
+                if link:
+                    pages.append(link)
+            elif image_link:
+                image = image_link
+        parsed.append({'pages': pages, 'image': image})
+    return parsed
+
+
+def parse_wolfram(xml: str):
+    """:return: {'success', 'plaintexts', 'images'}, plaintexts are the texts of all pods in order"""
+    if lxml:
+        root = lxml.etree.fromstring(xml.encode())
+        success = root.get('success')
+        plaintexts = [node.text or '' for node in root.iter('plaintext')]
+        images = [node.get('src') for node in root.iter('img')]
+    else:
+        match = WOLFRAM_SUCCESS_REGEX.search(xml)
+        success = match.group(1) if match else None
+        soup = BeautifulSoup(xml, 'html.parser', parse_only=SoupStrainer(['plaintext', 'img']))
+        plaintexts = [node.string or '' for node in soup.find_all('plaintext')]
+        images = [node.get('src') for node in soup.find_all('img')]
+    return {'success': success == 'true', 'plaintexts': plaintexts, 'images': images}
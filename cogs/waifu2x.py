@@ -1,5 +1,5 @@
 from discord.ext import commands
-import aiohttp
+from .utils.http import get_session
 class Waifu2x(commands.Cog):
     """
     For upscaling images and removing image noise
@@ -7,10 +7,7 @@ class Waifu2x(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-
-    def __unload(self):
-        self.session.close()
+        self.session = get_session(bot)
 
     @commands.command(pass_context=True)
     async def upscale(self,  ctxctx, url=None, scale='2x', noise='medium'):
@@ -1,8 +1,8 @@
-import aiohttp
 from discord.ext import commands
 import json
-from bs4 import BeautifulSoup
 from urllib import parse
+from .utils.scraping import run_parser, parse_wolfram
+from .utils.http import get_session
 
 
 class Wolfram(commands.Cog):
@@ -11,7 +11,7 @@ class Wolfram(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.json_file = 'data/wolfram.json'
-        self.session = aiohttp.ClientSession()
+        self.session = get_session(bot)
 
     @commands.command()
     async def wolfram(self,  ctx, *, query: str):
@@ -29,19 +29,16 @@ class Wolfram(commands.Cog):
             async with ctx.typing():
                 async with self.session.get(url=url, params=params) as response:
                     if response.status == 200:
-                        html = await response.text()
-                        soup = BeautifulSoup(html, 'html.parser')
-                        success = soup.find('queryresult')['success']
-                        if success == 'true':
-                            query_input = soup.find('plaintext').contents
+                        result = await run_parser(parse_wolfram, await response.text())
+                        if result['success']:
                             full_response = '<http://www.wolframalpha.com/input/?i={}>'.format(parse.quote_plus(query))
                             message = '**Full Response:** {} \n'.format(full_response)
-                            message += '**Input:** {} \n'.format(query_input[0])
+                            message += '**Input:** {} \n'.format(result['plaintexts'][0])
                             message += '**Result:** \n' \
                                        '```\n'
-                            for elem in soup.find_all('plaintext')[1:6]:
-                                if len(elem) > 0:
-                                    message += elem.contents[0] + '\n'
+                            for text in result['plaintexts'][1:6]:
+                                if len(text) > 0:
+                                    message += text + '\n'
                             message += '```'
 
                             await ctx.send(message)
@@ -54,23 +51,18 @@ class Wolfram(commands.Cog):
             async with ctx.typing():
                 async with self.session.get(url=url, params=params) as response:
                     if response.status == 200:
-                        soup = BeautifulSoup(await response.text(), 'html.parser')
-                        success = soup.find('queryresult')['success']
-                        if success == 'true':
-                            query_input = soup.find('plaintext').contents
+                        result = await run_parser(parse_wolfram, await response.text())
+                        if result['success']:
                             full_response = '<http://www.wolframalpha.com/input/?i={}>'.format(parse.quote_plus(re_query))
                             message = '**Full Response:** {} \n'.format(full_response)
-                            message += '**Input:** {} \n'.format(query_input[0])
+                            message += '**Input:** {} \n'.format(result['plaintexts'][0])
                             message += '**Result:** \n'
                             await ctx.send(message)
-                            for elem in soup.find_all('img')[1:5]:
-                                await ctx.send(elem['src'])
+                            for src in result['images'][1:5]:
+                                await ctx.send(src)
                         else:
                             await ctx.send('Query was unsuccessful please try something else')
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
-
 
 def setup(bot):
     bot.add_cog(Wolfram(bot))
@@ -11,6 +11,8 @@ from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import argparser, run_flow
 
+from .utils.message_scanner import get_scanner
+
 
 class Youtube(commands.Cog):
     """Youtube commands"""
@@ -34,6 +36,12 @@ class Youtube(commands.Cog):
         https://developers.google.com/api-client-library/python/guide/aaa_client_secrets
         """ % os.path.abspath(os.path.join(os.path.dirname(__file__),
                                            self.CLIENT_SECRETS_FILE))
+        self.scanner = get_scanner(bot)
+        self.scanner.register("youtube", self.on_youtube_link, phrases=('https://www.youtube', 'https://youtu.be'),
+                              check=lambda message: self.status and message.author == self.user)
+
+    def cog_unload(self):
+        self.scanner.unregister("youtube")
 
     @commands.command(pass_context=True)
     async def start(self, ctx):
@@ -68,16 +76,8 @@ class Youtube(commands.Cog):
         """links the Radio Touhou Night Playlist"""
         await ctx.send("https://www.youtube.com/playlist?list={}".format(self.playlist))
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if self.status and message.author == self.user and self.check_if_link(message.content):
-            await self.insert_videos_into_playlist(message.content)
-        else:
-            return
-
-    @staticmethod    
-    def check_if_link(content):
-        return 'https://www.youtube' in content or 'https://youtu.be' in content
+    async def on_youtube_link(self, message, match):
+        await self.insert_videos_into_playlist(message.content)
 
 
     async def insert_videos_into_playlist(self, link):
@@ -0,0 +1,85 @@
+import asyncio
+import re
+
+from cogs.utils.message_scanner import MessageScanner
+from cogs.utils.reddit_client import REDDIT_LINK_REGEX
+
+
+class FakeBot:
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.errors = []
+
+    def add_listener(self, func, name):
+        pass
+
+    async def on_error(self, event, *args):
+        self.errors.append(event)
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+async def noop(message, match):
+    pass
+
+
+def rule_names(scanner, content):
+    return sorted(rule.name for rule in scanner.scan(content))
+
+
+def test_overlapping_rules_both_match():
+    scanner = MessageScanner(FakeBot())
+    scanner.register("reddit", noop, pattern=REDDIT_LINK_REGEX)
+    scanner.register("uwu", noop, phrases=("uwu", "owo"), ignore_case=True)
+    assert rule_names(scanner, "https://redd.it/uwu123") == ["reddit", "uwu"]
+
+
+def test_overlap_does_not_depend_on_registration_order():
+    scanner = MessageScanner(FakeBot())
+    scanner.register("uwu", noop, phrases=("uwu", "owo"), ignore_case=True)
+    scanner.register("reddit", noop, pattern=REDDIT_LINK_REGEX)
+    assert rule_names(scanner, "https://redd.it/uwu123") == ["reddit", "uwu"]
+
+
+def test_rule_starting_inside_another_match():
+    scanner = MessageScanner(FakeBot())
+    scanner.register("word", noop, pattern=r"abc\w+")
+    scanner.register("digits", noop, pattern=r"\d{3}")
+    scanner.register("missing", noop, pattern=r"xyz")
+    assert rule_names(scanner, "see abc12345") == ["digits", "word"]
+
+
+def test_scoped_flags_and_no_match():
+    scanner = MessageScanner(FakeBot())
+    scanner.register("upper", noop, pattern=re.compile("HELLO"))
+    scanner.register("any_case", noop, pattern="hello", ignore_case=True)
+    assert rule_names(scanner, "hello there") == ["any_case"]
+    assert rule_names(scanner, "HELLO there") == ["any_case", "upper"]
+    assert scanner.scan("nothing to see") == []
+
+
+def test_on_message_calls_every_matching_rule():
+    async def run():
+        bot = FakeBot(asyncio.get_running_loop())
+        scanner = MessageScanner(bot)
+        called = dict()
+
+        def record(name):
+            async def callback(message, match):
+                called[name] = match.group(0) if match else None
+            return callback
+
+        scanner.register("reddit", record("reddit"), pattern=REDDIT_LINK_REGEX)
+        scanner.register("uwu", record("uwu"), phrases=("uwu",), ignore_case=True)
+        scanner.register("all", record("all"))
+        scanner.register("never", record("never"), check=lambda message: False, pattern="redd")
+        await scanner.on_message(FakeMessage("look https://redd.it/UwU123"))
+        await asyncio.sleep(0)
+        return called, bot.errors
+
+    called, errors = asyncio.run(run())
+    assert called == {"reddit": "https://redd.it/UwU123", "uwu": "UwU", "all": None}
+    assert errors == []